@@ -0,0 +1,5 @@
+import importlib.util
+
+# HTTP/2 multiplexes concurrent requests over one connection; it needs the optional h2 package,
+# and without it httpx falls back to HTTP/1.1 keep-alive
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
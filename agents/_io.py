@@ -0,0 +1,90 @@
+import json
+import asyncio
+from typing import Any, Union
+
+# orjson is an optional accelerator; fall back to the stdlib json module when it is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def read_text(path: str) -> str:
+    """
+    Read a UTF-8 text file.
+    
+    Args:
+        path: Path to the file.
+        
+    Returns:
+        The file contents.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+async def read_text_async(path: str) -> str:
+    """
+    Read a UTF-8 text file in a worker thread, so the event loop keeps serving other requests.
+    
+    Args:
+        path: Path to the file.
+        
+    Returns:
+        The file contents.
+    """
+    return await asyncio.to_thread(read_text, path)
+
+def dumps_json(obj: Any, pretty: bool = False) -> bytes:
+    """
+    Serialize an object to UTF-8 encoded JSON.
+    
+    Args:
+        obj: The JSON-serializable object.
+        pretty: Indent the output by two spaces.
+        
+    Returns:
+        The encoded JSON document.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0)
+    if pretty:
+        return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def loads_json(data: Union[str, bytes]) -> Any:
+    """
+    Parse a JSON document.
+    
+    Args:
+        data: The JSON document as text or UTF-8 bytes.
+        
+    Returns:
+        The parsed object. Invalid input raises json.JSONDecodeError (orjson's error subclasses it).
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def read_json(path: str) -> Any:
+    """
+    Read and parse a JSON file.
+    
+    Args:
+        path: Path to the file.
+        
+    Returns:
+        The parsed object.
+    """
+    with open(path, 'rb') as f:
+        return loads_json(f.read())
+
+def write_json(obj: Any, path: str, pretty: bool = False) -> None:
+    """
+    Serialize an object and write it to a JSON file.
+    
+    Args:
+        obj: The JSON-serializable object.
+        path: Path to the output file.
+        pretty: Indent the output by two spaces.
+    """
+    with open(path, 'wb') as f:
+        f.write(dumps_json(obj, pretty=pretty))
@@ -0,0 +1,91 @@
+import os
+import asyncio
+import weakref
+import functools
+
+import httpx
+from openai import AzureOpenAI, AsyncAzureOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+
+from agents._http import HTTP2_AVAILABLE
+
+# Upper bound on in-flight Azure OpenAI requests per event loop, to stay under the deployment's QPM quota
+MAX_CONCURRENT_REQUESTS = int(os.getenv("VERSA_MAX_CONCURRENT_REQUESTS", "4"))
+
+# Connection pool sizing, so sockets stay warm across the many requests of a pipeline run
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=30.0)
+
+# Reasoning models can take minutes to answer, so only the connect phase gets a short timeout
+HTTP_TIMEOUT = httpx.Timeout(600.0, connect=10.0)
+
+# Connection attempts that fail before a request is sent are retried by the transport
+TRANSPORT_RETRIES = 2
+
+# Rate limits (429), server errors (5xx), timeouts and dropped connections are retried by the SDK
+# with jittered exponential backoff, honouring Azure's retry-after headers; 6 attempts in total
+MAX_RETRIES = int(os.getenv("VERSA_MAX_RETRIES", "5"))
+
+_request_semaphores = weakref.WeakKeyDictionary()
+_async_clients = weakref.WeakKeyDictionary()
+
+@functools.lru_cache(maxsize=1)
+def get_client() -> AzureOpenAI:
+    """
+    Get the process-wide synchronous Azure OpenAI client, creating it on first use.
+
+    Sharing one client keeps its connection pool alive between agent calls, so each request
+    reuses an open TLS connection instead of paying for a new handshake.
+
+    Returns:
+        The shared AzureOpenAI client.
+    """
+    return AzureOpenAI(
+        api_key=os.environ["VERSA_OPENAI_API_KEY"],
+        api_version=os.environ['VERSA_API_VERSION'],
+        azure_endpoint=os.environ['VERSA_RESOURCE_ENDPOINT'],
+        max_retries=MAX_RETRIES,
+        # The pool limits must be set on the transport, which ignores the client-level ones
+        http_client=DefaultHttpxClient(
+            transport=httpx.HTTPTransport(http2=HTTP2_AVAILABLE, limits=HTTP_LIMITS, retries=TRANSPORT_RETRIES),
+            timeout=HTTP_TIMEOUT
+        )
+    )
+
+def get_async_client() -> AsyncAzureOpenAI:
+    """
+    Get the Azure OpenAI client of the running event loop, creating it on first use.
+
+    An httpx connection pool cannot be shared across event loops, so one client is kept per
+    loop and reused by every call made on it, which preserves pooled TLS connections.
+
+    Returns:
+        The AsyncAzureOpenAI client for the current loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = AsyncAzureOpenAI(
+            api_key=os.environ["VERSA_OPENAI_API_KEY"],
+            api_version=os.environ['VERSA_API_VERSION'],
+            azure_endpoint=os.environ['VERSA_RESOURCE_ENDPOINT'],
+            max_retries=MAX_RETRIES,
+            http_client=DefaultAsyncHttpxClient(
+                transport=httpx.AsyncHTTPTransport(http2=HTTP2_AVAILABLE, limits=HTTP_LIMITS, retries=TRANSPORT_RETRIES),
+                timeout=HTTP_TIMEOUT
+            )
+        )
+        _async_clients[loop] = client
+    return client
+
+def request_slot() -> asyncio.Semaphore:
+    """
+    Get the semaphore that bounds concurrent LLM requests on the running event loop.
+
+    Returns:
+        An asyncio.Semaphore shared by every agent call made on the current loop.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = _request_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        _request_semaphores[loop] = semaphore
+    return semaphore
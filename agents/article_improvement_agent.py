@@ -1,55 +1,70 @@
+"""
+Revise a perspective article based on reviewer feedback.
+
+Run from the repository root with `python -m agents.article_improvement_agent`.
+"""
 import os
-from openai import AzureOpenAI
-from typing import Dict, Any
+import asyncio
+from typing import Dict, Any, Optional
+
+from agents._io import read_text_async
+from agents._llm_client import get_async_client, request_slot
+from agents.cache import semantic_cache
+
+IMPROVEMENT_INSTRUCTIONS = """You are an experienced scientific writer tasked with refining and improving a scientific perspective article based on constructive feedback provided by an expert reviewer. Your goal is to thoughtfully incorporate the reviewer's suggestions, enhancing the manuscript's clarity, coherence, scholarly rigor, and intellectual contribution.
+
+You will receive the original transcript that was used to create this article (TRANSCRIPT), followed by the current version of the article (ARTICLE) and the review feedback (REVIEW FEEDBACK).
+
+Please provide an improved version of the article based on the feedback. Maintain the same overall structure, but address all the issues raised by the reviewer."""
 
-def improve_article(article_text: str, review_feedback: str, transcript_text: str, output_path: str) -> str:
+@semantic_cache(threshold=0.95, context=("iteration",))
+async def _request_improvement(article_text: str, review_feedback: str, transcript_text: str, *, iteration: int) -> str:
     """
-    Improve the article based on review feedback.
+    Ask the model for an improved version of the article.
     
     Args:
         article_text: The article text with references.
         review_feedback: The review feedback for improvement.
         transcript_text: The original transcript text.
-        output_path: Path to save the improved article.
+        iteration: Number of review and improvement rounds the article has already been through.
         
     Returns:
-        Path to the saved improved article file.
+        The improved article text.
     """
-    client = AzureOpenAI(
-        api_key=os.environ["VERSA_OPENAI_API_KEY"],
-        api_version=os.environ['VERSA_API_VERSION'],
-        azure_endpoint=os.environ['VERSA_RESOURCE_ENDPOINT']
-    )
-    
-    prompt = f"""
-    You are an experienced scientific writer tasked with refining and improving a scientific perspective article based on constructive feedback provided by an expert reviewer. Your goal is to thoughtfully incorporate the reviewer's suggestions, enhancing the manuscript's clarity, coherence, scholarly rigor, and intellectual contribution.
+    client = get_async_client()
     
-    Here is the current version of the article:
-    
-    {article_text}
-    
-    Here is the review feedback:
-    
-    {review_feedback}
-    
-    Here is the original transcript that was used to create this article:
-    
-    {transcript_text}
-    
-    Please provide an improved version of the article based on the feedback. Maintain the same overall structure, but address all the issues raised by the reviewer.
-    """
+    prompt = "ARTICLE:\n\n" + article_text + "\n\nREVIEW FEEDBACK:\n\n" + review_feedback
     
     print("Improving the article based on reviewer feedback")
     
-    response = client.chat.completions.create(
-        model="o1-2024-12-17",
-        messages=[
-            {"role": "user", "content": prompt}
-        ],
-        reasoning_effort="high"
-    )
+    async with request_slot():
+        response = await client.chat.completions.create(
+            model="o1-2024-12-17",
+            messages=[
+                {"role": "system", "content": IMPROVEMENT_INSTRUCTIONS},
+                {"role": "user", "content": "TRANSCRIPT:\n\n" + transcript_text},
+                {"role": "user", "content": prompt}
+            ],
+            reasoning_effort="high"
+        )
+    
+    return response.choices[0].message.content
+
+async def improve_article_text_async(article_text: str, review_feedback: str, transcript_text: str, output_path: str, iteration: int = 0) -> str:
+    """
+    Improve the article based on review feedback and save it, for callers that go on using the text.
     
-    improved_article = response.choices[0].message.content
+    Args:
+        article_text: The article text with references.
+        review_feedback: The review feedback for improvement.
+        transcript_text: The original transcript text.
+        output_path: Path to save the improved article.
+        iteration: Number of review and improvement rounds the article has already been through.
+        
+    Returns:
+        The improved article text.
+    """
+    improved_article = await _request_improvement(article_text, review_feedback, transcript_text, iteration=iteration)
     
     # Create output directory if it doesn't exist
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
@@ -59,34 +74,85 @@ def improve_article(article_text: str, review_feedback: str, transcript_text: st
         f.write(improved_article)
     
     print(f"Improved article generated and saved to {output_path}")
+    return improved_article
+
+async def improve_article_async(article_text: str, review_feedback: str, transcript_text: str, output_path: str, iteration: int = 0) -> str:
+    """
+    Improve the article based on review feedback using the async Azure OpenAI client.
+    
+    Args:
+        article_text: The article text with references.
+        review_feedback: The review feedback for improvement.
+        transcript_text: The original transcript text.
+        output_path: Path to save the improved article.
+        iteration: Number of review and improvement rounds the article has already been through.
+        
+    Returns:
+        Path to the saved improved article file.
+    """
+    await improve_article_text_async(article_text, review_feedback, transcript_text, output_path, iteration)
     return output_path
 
-def run_article_improvement_agent(article_path: str, review_feedback_path: str, transcript_path: str, output_path: str) -> str:
+def improve_article(article_text: str, review_feedback: str, transcript_text: str, output_path: str, iteration: int = 0) -> str:
     """
-    Run the article improvement agent.
+    Improve the article based on review feedback.
+    
+    Args:
+        article_text: The article text with references.
+        review_feedback: The review feedback for improvement.
+        transcript_text: The original transcript text.
+        output_path: Path to save the improved article.
+        iteration: Number of review and improvement rounds the article has already been through.
+        
+    Returns:
+        Path to the saved improved article file.
+    """
+    return asyncio.run(improve_article_async(article_text, review_feedback, transcript_text, output_path, iteration))
+
+async def run_article_improvement_agent_async(article_path: str, review_feedback_path: str, transcript_path: str, output_path: str, transcript_text: Optional[str] = None) -> str:
+    """
+    Run the article improvement agent inside an event loop.
     
     Args:
         article_path: Path to the article file with references.
         review_feedback_path: Path to the review feedback file.
         transcript_path: Path to the original transcript file.
         output_path: Path to save the improved article.
+        transcript_text: The transcript, if the caller already holds it; transcript_path is then not read.
         
     Returns:
         Path to the saved improved article file.
     """
-    # Read the article
-    with open(article_path, 'r', encoding='utf-8') as f:
-        article_text = f.read()
-    
-    # Read the review feedback
-    with open(review_feedback_path, 'r', encoding='utf-8') as f:
-        review_feedback = f.read()
-    
-    # Read the transcript
-    with open(transcript_path, 'r', encoding='utf-8') as f:
-        transcript_text = f.read()
+    if transcript_text is None:
+        # Read the article, review feedback and transcript concurrently
+        article_text, review_feedback, transcript_text = await asyncio.gather(
+            read_text_async(article_path),
+            read_text_async(review_feedback_path),
+            read_text_async(transcript_path)
+        )
+    else:
+        article_text, review_feedback = await asyncio.gather(
+            read_text_async(article_path),
+            read_text_async(review_feedback_path)
+        )
+    
+    return await improve_article_async(article_text, review_feedback, transcript_text, output_path)
+
+def run_article_improvement_agent(article_path: str, review_feedback_path: str, transcript_path: str, output_path: str, transcript_text: Optional[str] = None) -> str:
+    """
+    Run the article improvement agent.
     
-    return improve_article(article_text, review_feedback, transcript_text, output_path)
+    Args:
+        article_path: Path to the article file with references.
+        review_feedback_path: Path to the review feedback file.
+        transcript_path: Path to the original transcript file.
+        output_path: Path to save the improved article.
+        transcript_text: The transcript, if the caller already holds it; transcript_path is then not read.
+        
+    Returns:
+        Path to the saved improved article file.
+    """
+    return asyncio.run(run_article_improvement_agent_async(article_path, review_feedback_path, transcript_path, output_path, transcript_text))
 
 if __name__ == "__main__":
     # Test the agent
@@ -1,82 +1,187 @@
+"""
+Review a perspective article with an LLM and local narrative-flow metrics.
+
+Run from the repository root with `python -m agents.article_review_agent`.
+"""
 import os
 import re
 import json
-from openai import AzureOpenAI
+import asyncio
+import functools
 from typing import Dict, Any, List, TypedDict, Optional
 import nltk
+import numpy as np
 from pydantic import BaseModel, Field
 
-# Download NLTK resources if needed
-try:
-    nltk.data.find('tokenizers/punkt')
-except LookupError:
-    nltk.download('punkt')
+from nltk.tokenize import NLTKWordTokenizer
+
+from agents._io import read_text_async, loads_json, write_json
+from agents._llm_client import get_async_client, request_slot
+from agents.cache import semantic_cache
+from agents.retrieval import split_sentences
+from agents.schema import strict_response_format
+
+# Static review framework, sent as the system message so it forms a stable prefix for prompt caching
+REVIEW_INSTRUCTIONS = """# LLM Instructions for Reviewing Scientific Perspective Articles
+You are an expert scientific reviewer tasked with evaluating and providing feedback on a scientific perspective article. Your analysis should embody the highest standards of academic rigor while offering constructive guidance to improve the manuscript.
+
+## Evaluation Framework
+Assess the perspective article through these interconnected dimensions, providing thoughtful analysis that emerges naturally from your expert understanding:
+Examine how effectively the article presents forward-looking ideas and speculative models within a focused field, rather than attempting a comprehensive literature survey. Consider whether the author maintains balance while expressing personal viewpoints, and how well the article stimulates discussion and new experimental approaches.
+Assess the article's conceptual foundations and theoretical coherence. Determine whether ideas develop logically and if the author effectively establishes connections between existing knowledge and proposed conceptual innovations.
+Evaluate the accessibility of language, clarity of novel concept definitions, and explanations of specialist terminology. Consider how well the author communicates complex ideas to readers who may not be specialists in the specific subfield.
+Analyze how the author engages with opposing viewpoints while maintaining their perspective. Consider whether the article acknowledges limitations and uncertainties appropriately.
+
+## Content Analysis
+Your review should address:
+- How effectively the preface (maximum 200 words) sets the stage and summarizes the key message
+- Whether the perspective maintains appropriate scope and focus on a specific topical aspect
+- Balance between presenting personal viewpoints and acknowledging alternative perspectives
+- Use of accessible language and clear definitions of novel concepts
+- Integration and explanation of specialist terminology
+- Appropriate length (Minimum 8 pages, maximum 10 pages with minimum 4,000 and maximum 5,000 words)
+
+## Scholarly Standards
+Your analysis should provide sophisticated engagement with:
+- Theoretical coherence and intellectual rigor of the perspective
+- Integration of the perspective within the broader scientific discourse
+- Potential impact on stimulating discussion and new experimental approaches
+- Balance between speculation and evidence-based reasoning
+- Originality and innovative thinking within established scientific frameworks
+
+## Narrative Flow Analysis
+Pay special attention to the flow and transitions between paragraphs. Quantitative narrative metrics for the article are provided in the NARRATIVE METRICS section of the user message.
+
+Provide specific feedback on how to improve narrative flow and paragraph transitions. Look for abrupt topic changes, disconnected ideas, and opportunities to create more coherent progression of thought.
+
+## Feedback Approach
+Develop your analysis through a thoughtful progression:
+Begin by situating your evaluation within the context of the article's aims and field. Allow your assessment to emerge organically from engagement with the manuscript's strengths and limitations.
+Develop your critique through careful consideration of the perspective's contributions, building complexity while maintaining clarity about essential improvements needed.
+Integrate suggestions for enhancement naturally within your analytical flow, connecting them to specific elements of the manuscript.
+Maintain a tone that is rigorous yet constructive, scholarly yet accessible, and critical yet respectful of the author's intellectual contributions.
+
+You will receive the original transcript that was used to create this article (TRANSCRIPT), followed by the article to review (ARTICLE) and its narrative metrics (NARRATIVE METRICS)."""
+
+# Only this short block is rendered per call; it goes last so everything before it can be prefix-cached
+NARRATIVE_METRICS_TEMPLATE = """NARRATIVE METRICS:
+- Current word count: {word_count} words
+- Average paragraph length: {avg_paragraph_length:.2f} words
+- Paragraph length variance: {paragraph_length_variance:.2f}
+- Average transition quality between paragraphs: {avg_transition_quality:.2f} (scale 0-1)
+- Transition word density: {transition_density:.2f} per paragraph"""
 
-from nltk.tokenize import sent_tokenize, word_tokenize
+# Regex tokenization is used by default: the narrative metrics only need word counts and leading words,
+# not Penn Treebank tokens, and compiled patterns are much faster than NLTK's Python tokenizers
+_WORD_RE = re.compile(r"\b\w+\b")
+
+# NLTK tokenizers for use_nltk=True, created once and called directly instead of going through
+# sent_tokenize/word_tokenize, which re-resolve the language model on every call
+_WORD_TOKENIZER = NLTKWordTokenizer()
+
+@functools.lru_cache(maxsize=1)
+def _sentence_tokenizer():
+    """Load the pretrained English Punkt model on first use, downloading it if needed."""
+    # Only use_nltk=True needs the model, so the default regex path never touches the network
+    for resource in ('punkt', 'punkt_tab'):
+        try:
+            nltk.data.find(f'tokenizers/{resource}')
+        except LookupError:
+            nltk.download(resource)
+    
+    try:
+        return nltk.tokenize.PunktTokenizer("english")
+    except AttributeError:
+        # NLTK releases before PunktTokenizer ship the model as a pickle
+        return nltk.data.load("tokenizers/punkt/english.pickle")
 
 class NarrativeAnalyzer:
     """Analyzes narrative flow and transitions between paragraphs"""
     
-    def __init__(self):
-        self.transition_words = set([
+    def __init__(self, use_nltk: bool = False):
+        # use_nltk=True restores NLTK's Punkt/Treebank tokenization for exact compatibility with earlier metrics
+        self.use_nltk = use_nltk
+        self.transition_words = frozenset([
             'moreover', 'furthermore', 'consequently', 'therefore',
             'however', 'nevertheless', 'indeed', 'specifically',
             'conversely', 'similarly', 'likewise', 'instead',
             'nonetheless', 'meanwhile', 'subsequently', 'ultimately'
         ])
     
+    def split_sentences(self, text: str) -> List[str]:
+        """Split text into sentences"""
+        if self.use_nltk:
+            return _sentence_tokenizer().tokenize(text)
+        return split_sentences(text)
+    
+    def split_words(self, text: str) -> List[str]:
+        """Split text into word tokens"""
+        if self.use_nltk:
+            return _WORD_TOKENIZER.tokenize(text)
+        return _WORD_RE.findall(text)
+    
+    def _significant_words(self, words: List[str]) -> set:
+        """Lower-cased alphabetic words longer than four letters"""
+        return set(word.lower() for word in words if len(word) > 4 and word.isalpha())
+    
     def analyze_transitions(self, text: str) -> Dict:
         """Analyze paragraph transitions and flow"""
         paragraphs = [p for p in text.split('\n\n') if p.strip()]
-        sentences = sent_tokenize(text)
-        words = word_tokenize(text)
-        
-        # Analyze transition words usage
-        transition_count = sum(1 for word in words if word.lower() in self.transition_words)
         
-        # Analyze sentence and paragraph lengths
-        sentence_lengths = [len(word_tokenize(sent)) for sent in sentences]
-        paragraph_lengths = [len(word_tokenize(para)) for para in paragraphs]
-        
-        # Analyze first and last sentences of paragraphs for transitions
+        transition_count = 0
+        sentence_lengths = []
+        paragraph_lengths = []
         paragraph_transitions = []
-        for i in range(1, len(paragraphs)):
-            prev_para_last = sent_tokenize(paragraphs[i-1])[-1] if sent_tokenize(paragraphs[i-1]) else ""
-            curr_para_first = sent_tokenize(paragraphs[i])[0] if sent_tokenize(paragraphs[i]) else ""
-            
-            transition_quality = 0
-            # Check for transition words at start of paragraph
-            first_words = word_tokenize(curr_para_first.lower())[:3]
-            if any(word in self.transition_words for word in first_words):
-                transition_quality += 0.5
+        
+        # Single pass over the text: each paragraph is tokenized once and every metric is
+        # accumulated inline. Only the previous paragraph's last-sentence words are carried over.
+        prev_last_words = None
+        for para in paragraphs:
+            para_length = 0
+            first_sentence = last_sentence = []
+            for i, sent in enumerate(self.split_sentences(para)):
+                words = self.split_words(sent)
+                
+                # Analyze transition words usage and sentence length
+                transition_count += sum(1 for word in words if word.lower() in self.transition_words)
+                sentence_lengths.append(len(words))
+                para_length += len(words)
                 
-            # Check for thematic connection between paragraphs
-            # (simplified: check for shared significant words)
-            prev_words = set(word.lower() for word in word_tokenize(prev_para_last) 
-                           if len(word) > 4 and word.isalpha())
-            curr_words = set(word.lower() for word in word_tokenize(curr_para_first) 
-                           if len(word) > 4 and word.isalpha())
+                if i == 0:
+                    first_sentence = words
+                last_sentence = words
+            
+            paragraph_lengths.append(para_length)
             
-            if prev_words.intersection(curr_words):
-                transition_quality += 0.5
+            # Analyze the transition from the previous paragraph's last sentence into this one
+            if prev_last_words is not None:
+                transition_quality = 0
+                # Check for transition words at start of paragraph
+                if any(word.lower() in self.transition_words for word in first_sentence[:3]):
+                    transition_quality += 0.5
                 
-            paragraph_transitions.append(transition_quality)
+                # Check for thematic connection between paragraphs
+                # (simplified: check for shared significant words)
+                if prev_last_words.intersection(self._significant_words(first_sentence)):
+                    transition_quality += 0.5
+                
+                paragraph_transitions.append(transition_quality)
+            
+            prev_last_words = self._significant_words(last_sentence)
+        
+        sentence_lengths = np.asarray(sentence_lengths, dtype=np.int32)
+        paragraph_lengths = np.asarray(paragraph_lengths, dtype=np.int32)
         
         return {
+            "word_count": int(paragraph_lengths.sum()),
             "transition_density": transition_count / max(len(paragraphs), 1),
-            "avg_sentence_length": sum(sentence_lengths) / max(len(sentence_lengths), 1),
-            "sentence_length_variance": self._variance(sentence_lengths),
-            "avg_paragraph_length": sum(paragraph_lengths) / max(len(paragraph_lengths), 1),
-            "paragraph_length_variance": self._variance(paragraph_lengths),
+            "avg_sentence_length": float(sentence_lengths.mean()) if sentence_lengths.size else 0.0,
+            "sentence_length_variance": float(sentence_lengths.var()) if sentence_lengths.size else 0.0,
+            "avg_paragraph_length": float(paragraph_lengths.mean()) if paragraph_lengths.size else 0.0,
+            "paragraph_length_variance": float(paragraph_lengths.var()) if paragraph_lengths.size else 0.0,
             "paragraph_transition_scores": paragraph_transitions,
             "avg_transition_quality": sum(paragraph_transitions) / max(len(paragraph_transitions), 1) if paragraph_transitions else 0
         }
-    
-    def _variance(self, numbers: List[int]) -> float:
-        if not numbers:
-            return 0
-        mean = sum(numbers) / len(numbers)
-        return sum((x - mean) ** 2 for x in numbers) / len(numbers)
 
 # Define Pydantic models for structured output
 class OverallAssessment(BaseModel):
@@ -110,102 +215,72 @@ class ArticleReview(BaseModel):
     content_recommendations: ContentRecommendations
     summary_evaluation: str = Field(..., description="Overall conclusion of the evaluation (250-300 words)")
 
-def review_article(article_text: str, transcript_text: str, output_path: str) -> str:
+ARTICLE_REVIEW_FORMAT = strict_response_format(ArticleReview)
+
+# A revised article is close enough to its predecessor to match it, so the iteration is part of the key
+@semantic_cache(threshold=0.95, context=("iteration",), validate=ArticleReview.model_validate_json)
+async def _request_review(article_text: str, transcript_text: str, *, narrative_analysis: Dict, iteration: int) -> str:
     """
-    Review the article and provide feedback for improvement.
+    Ask the model for a structured review of the article.
     
     Args:
         article_text: The article text with references.
         transcript_text: The original transcript text.
-        output_path: Path to save the review feedback.
+        narrative_analysis: Narrative metrics computed from the article.
+        iteration: Number of review and improvement rounds the article has already been through.
         
     Returns:
-        Path to the saved review feedback file.
+        The review as a JSON string following the ArticleReview schema.
     """
-    # Create narrative analyzer
-    narrative_analyzer = NarrativeAnalyzer()
-    narrative_analysis = narrative_analyzer.analyze_transitions(article_text)
-    
-    client = AzureOpenAI(
-        api_key=os.environ["VERSA_OPENAI_API_KEY"],
-        api_version=os.environ['VERSA_API_VERSION'],
-        azure_endpoint=os.environ['VERSA_RESOURCE_ENDPOINT']
-    )
-    
-    # Extract word count
-    word_count = len(word_tokenize(article_text))
-    
-    prompt = f"""
-    # LLM Instructions for Reviewing Scientific Perspective Articles
-    You are an expert scientific reviewer tasked with evaluating and providing feedback on a scientific perspective article. Your analysis should embody the highest standards of academic rigor while offering constructive guidance to improve the manuscript.
-    
-    ## Evaluation Framework
-    Assess the perspective article through these interconnected dimensions, providing thoughtful analysis that emerges naturally from your expert understanding:
-    Examine how effectively the article presents forward-looking ideas and speculative models within a focused field, rather than attempting a comprehensive literature survey. Consider whether the author maintains balance while expressing personal viewpoints, and how well the article stimulates discussion and new experimental approaches.
-    Assess the article's conceptual foundations and theoretical coherence. Determine whether ideas develop logically and if the author effectively establishes connections between existing knowledge and proposed conceptual innovations.
-    Evaluate the accessibility of language, clarity of novel concept definitions, and explanations of specialist terminology. Consider how well the author communicates complex ideas to readers who may not be specialists in the specific subfield.
-    Analyze how the author engages with opposing viewpoints while maintaining their perspective. Consider whether the article acknowledges limitations and uncertainties appropriately.
-    
-    ## Content Analysis
-    Your review should address:
-    - How effectively the preface (maximum 200 words) sets the stage and summarizes the key message
-    - Whether the perspective maintains appropriate scope and focus on a specific topical aspect
-    - Balance between presenting personal viewpoints and acknowledging alternative perspectives
-    - Use of accessible language and clear definitions of novel concepts
-    - Integration and explanation of specialist terminology
-    - Appropriate length (Minimum 8 pages, maximum 10 pages with minimum 4,000 and maximum 5,000 words)
-    
-    ## Scholarly Standards
-    Your analysis should provide sophisticated engagement with:
-    - Theoretical coherence and intellectual rigor of the perspective
-    - Integration of the perspective within the broader scientific discourse
-    - Potential impact on stimulating discussion and new experimental approaches
-    - Balance between speculation and evidence-based reasoning
-    - Originality and innovative thinking within established scientific frameworks
-    
-    ## Narrative Flow Analysis
-    Pay special attention to the flow and transitions between paragraphs. The article shows the following metrics:
-    - Current word count: {word_count} words
-    - Average paragraph length: {narrative_analysis['avg_paragraph_length']:.2f} words
-    - Paragraph length variance: {narrative_analysis['paragraph_length_variance']:.2f}
-    - Average transition quality between paragraphs: {narrative_analysis['avg_transition_quality']:.2f} (scale 0-1)
-    - Transition word density: {narrative_analysis['transition_density']:.2f} per paragraph
+    client = get_async_client()
     
-    Provide specific feedback on how to improve narrative flow and paragraph transitions. Look for abrupt topic changes, disconnected ideas, and opportunities to create more coherent progression of thought.
+    # The transcript is the same for every call of a run, so it goes before the article
+    prompt = "ARTICLE:\n\n" + article_text + "\n\n" + NARRATIVE_METRICS_TEMPLATE.format(**narrative_analysis)
     
-    ## Feedback Approach
-    Develop your analysis through a thoughtful progression:
-    Begin by situating your evaluation within the context of the article's aims and field. Allow your assessment to emerge organically from engagement with the manuscript's strengths and limitations.
-    Develop your critique through careful consideration of the perspective's contributions, building complexity while maintaining clarity about essential improvements needed.
-    Integrate suggestions for enhancement naturally within your analytical flow, connecting them to specific elements of the manuscript.
-    Maintain a tone that is rigorous yet constructive, scholarly yet accessible, and critical yet respectful of the author's intellectual contributions.
-    
-    Here is the article to review:
-    
-    {article_text}
-    
-    Here is the original transcript that was used to create this article:
+    print("Reviewing the perspective article")
     
-    {transcript_text}
+    # The ArticleReview schema is precomputed, so the plain create call skips per-call schema generation
+    async with request_slot():
+        response = await client.chat.completions.create(
+            model="gpt-4o-2024-08-06", #"o1-mini-2024-09-12",
+            messages=[
+                {"role": "system", "content": REVIEW_INSTRUCTIONS},
+                {"role": "user", "content": "TRANSCRIPT:\n\n" + transcript_text},
+                {"role": "user", "content": prompt}
+            ],
+            response_format=ARTICLE_REVIEW_FORMAT
+        )
+    
+    return response.choices[0].message.content
+
+async def review_article_async(article_text: str, transcript_text: str, output_path: str, pretty: bool = False, iteration: int = 0) -> str:
     """
+    Review the article and provide feedback for improvement using the async Azure OpenAI client.
     
-    print("Reviewing the perspective article")
+    Args:
+        article_text: The article text with references.
+        transcript_text: The original transcript text.
+        output_path: Path to save the review feedback.
+        pretty: Indent the saved JSON files for human reading.
+        iteration: Number of review and improvement rounds the article has already been through.
+        
+    Returns:
+        Path to the saved review feedback file.
+    """
+    # Create narrative analyzer
+    narrative_analyzer = NarrativeAnalyzer()
     
-    # Use beta.chat.completions with direct Pydantic model specification
-    response = client.beta.chat.completions.parse(
-        model="gpt-4o-2024-08-06", #"o1-mini-2024-09-12",
-        messages=[
-            {"role": "user", "content": prompt}
-        ],
-        response_format=ArticleReview
-    )
+    # Tokenization is CPU-bound, so run it in a worker thread to keep the event loop
+    # free for the API calls of other manuscripts reviewed concurrently. The analysis
+    # includes the word count, so the article is not tokenized a second time.
+    narrative_analysis = await asyncio.to_thread(narrative_analyzer.analyze_transitions, article_text)
     
     # Parse the string response into a structured format
-    review_output = response.choices[0].message.content
+    review_output = await _request_review(article_text, transcript_text, narrative_analysis=narrative_analysis, iteration=iteration)
     
     # Method 1: If the output is already JSON-formatted
     try:
-        raw_result = json.loads(review_output)
+        raw_result = loads_json(review_output)
         article_review = ArticleReview(**raw_result)
         review_feedback = article_review.model_dump()
     except (json.JSONDecodeError, TypeError, ValueError):
@@ -217,41 +292,74 @@ def review_article(article_text: str, transcript_text: str, output_path: str) ->
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
     
     # Save the review feedback to file
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(review_feedback, f, indent=2)
+    write_json(review_feedback, output_path, pretty=pretty)
     
     # Also save narrative analysis separately
     narrative_output_path = os.path.join(os.path.dirname(output_path), 
                                         os.path.basename(output_path).split('.')[0] + '_narrative_analysis.json')
-    with open(narrative_output_path, 'w', encoding='utf-8') as f:
-        json.dump(narrative_analysis, f, indent=2)
+    write_json(narrative_analysis, narrative_output_path, pretty=pretty)
     
     print(f"Review feedback generated and saved to {output_path}")
     print(f"Narrative analysis saved to {narrative_output_path}")
     
     return output_path
 
-def run_article_review_agent(article_path: str, transcript_path: str, output_path: str) -> str:
+def review_article(article_text: str, transcript_text: str, output_path: str, pretty: bool = False, iteration: int = 0) -> str:
     """
-    Run the article review agent.
+    Review the article and provide feedback for improvement.
+    
+    Args:
+        article_text: The article text with references.
+        transcript_text: The original transcript text.
+        output_path: Path to save the review feedback.
+        pretty: Indent the saved JSON files for human reading.
+        iteration: Number of review and improvement rounds the article has already been through.
+        
+    Returns:
+        Path to the saved review feedback file.
+    """
+    return asyncio.run(review_article_async(article_text, transcript_text, output_path, pretty, iteration))
+
+async def run_article_review_agent_async(article_path: str, transcript_path: str, output_path: str, pretty: bool = False, transcript_text: Optional[str] = None) -> str:
+    """
+    Run the article review agent inside an event loop.
     
     Args:
         article_path: Path to the article file with references.
         transcript_path: Path to the original transcript file.
         output_path: Path to save the review feedback.
+        pretty: Indent the saved JSON files for human reading.
+        transcript_text: The transcript, if the caller already holds it; transcript_path is then not read.
         
     Returns:
         Path to the saved review feedback file.
     """
-    # Read the article
-    with open(article_path, 'r', encoding='utf-8') as f:
-        article_text = f.read()
-    
-    # Read the transcript
-    with open(transcript_path, 'r', encoding='utf-8') as f:
-        transcript_text = f.read()
+    if transcript_text is None:
+        # Read the article and transcript concurrently
+        article_text, transcript_text = await asyncio.gather(
+            read_text_async(article_path),
+            read_text_async(transcript_path)
+        )
+    else:
+        article_text = await read_text_async(article_path)
+    
+    return await review_article_async(article_text, transcript_text, output_path, pretty)
+
+def run_article_review_agent(article_path: str, transcript_path: str, output_path: str, pretty: bool = False, transcript_text: Optional[str] = None) -> str:
+    """
+    Run the article review agent.
     
-    return review_article(article_text, transcript_text, output_path)
+    Args:
+        article_path: Path to the article file with references.
+        transcript_path: Path to the original transcript file.
+        output_path: Path to save the review feedback.
+        pretty: Indent the saved JSON files for human reading.
+        transcript_text: The transcript, if the caller already holds it; transcript_path is then not read.
+        
+    Returns:
+        Path to the saved review feedback file.
+    """
+    return asyncio.run(run_article_review_agent_async(article_path, transcript_path, output_path, pretty, transcript_text))
 
 if __name__ == "__main__":
     # Test the agent
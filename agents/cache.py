@@ -0,0 +1,288 @@
+import os
+import re
+import time
+import hashlib
+import sqlite3
+import functools
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from agents._io import dumps_json, loads_json
+from agents._llm_client import get_async_client, request_slot
+
+# Directory holding all on-disk caches
+CACHE_DIR = os.getenv("AI_WRITER_CACHE_DIR", "data/cache")
+
+# Embedding deployment used to key the semantic cache
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# text-embedding-3-small accepts up to 8191 tokens per input; longer texts are split into segments of this size
+MAX_SEGMENT_CHARS = 20000
+
+# Hit/miss counters for the semantic cache, shared across all decorated functions
+cache_stats = {"hits": 0, "misses": 0}
+
+# LLM response caching can be switched off for a run (main.py --no-cache)
+_llm_cache_enabled = True
+
+_REFERENCES_BLOCK_RE = re.compile(r"\n[#*\s]*references[*:\s]*\n.*\Z", re.IGNORECASE | re.DOTALL)
+_WHITESPACE_RE = re.compile(r"\s+")
+
+def canonicalize(text: str) -> str:
+    """
+    Normalize text before embedding so cosmetic differences do not cause cache misses.
+
+    Args:
+        text: Raw input text.
+
+    Returns:
+        The text without its trailing references block and with whitespace collapsed.
+    """
+    text = _REFERENCES_BLOCK_RE.sub("", text)
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+def _segment(texts: Sequence[str]) -> Tuple[List[str], str]:
+    """Split each canonicalized text into embeddable segments and describe the split as a signature."""
+    segments = []
+    counts = []
+    for text in texts:
+        text = canonicalize(text)
+        parts = [text[i:i + MAX_SEGMENT_CHARS] for i in range(0, len(text), MAX_SEGMENT_CHARS)] or [""]
+        segments.extend(parts)
+        counts.append(str(len(parts)))
+    return segments, ",".join(counts)
+
+def _normalized(response) -> np.ndarray:
+    """Stack the embeddings of a response into L2-normalized rows."""
+    vectors = np.array([item.embedding for item in response.data], dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+async def embed(segments: List[str]) -> np.ndarray:
+    """Embed segments in a single request and return L2-normalized rows."""
+    client = get_async_client()
+    # The embeddings endpoint rejects empty strings
+    async with request_slot():
+        response = await client.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=[segment or " " for segment in segments]
+        )
+    return _normalized(response)
+
+def _context_hash(values: Dict[str, Any]) -> str:
+    """Hash the inputs that must match exactly for a cached completion to be reused."""
+    return hashlib.blake2b(dumps_json(values), digest_size=16).hexdigest()
+
+def _is_valid(content: str, validate: Optional[Callable[[str], Any]]) -> bool:
+    """Whether a completion passes the caller's validator, so a malformed answer is never stored."""
+    if validate is None:
+        return True
+    try:
+        validate(content)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+def set_llm_cache_enabled(enabled: bool) -> None:
+    """Turn the semantic and exact LLM response caches on or off for this process."""
+    global _llm_cache_enabled
+    _llm_cache_enabled = enabled
+
+class DiskCache:
+    """SQLite-backed key/value store for JSON-serializable values with optional expiry"""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, expires_at REAL)")
+        self.conn.commit()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Return the value stored under key, or default if it is missing or expired."""
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """Return a dict with the unexpired values of the keys that are present."""
+        keys = list(keys)
+        found = {}
+        now = time.time()
+        # Stay below SQLite's default limit on bound parameters
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = self.conn.execute(
+                f"SELECT key, value FROM entries WHERE key IN ({','.join('?' * len(chunk))}) "
+                "AND (expires_at IS NULL OR expires_at > ?)",
+                (*chunk, now)
+            ).fetchall()
+            found.update((key, loads_json(value)) for key, value in rows)
+        return found
+
+    def set(self, key: str, value: Any, expire: Optional[float] = None) -> None:
+        """Store value under key, expiring after `expire` seconds if given."""
+        self.set_many({key: value}, expire)
+
+    def set_many(self, items: Dict[str, Any], expire: Optional[float] = None) -> None:
+        """Store several values at once, expiring after `expire` seconds if given."""
+        expires_at = time.time() + expire if expire is not None else None
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO entries (key, value, expires_at) VALUES (?, ?, ?)",
+            [(key, dumps_json(value), expires_at) for key, value in items.items()]
+        )
+        self.conn.commit()
+
+@functools.lru_cache(maxsize=None)
+def get_disk_cache(name: str) -> DiskCache:
+    """Open the process-wide key/value cache with the given name."""
+    return DiskCache(os.path.join(CACHE_DIR, f"{name}.db"))
+
+class SemanticCache:
+    """SQLite-backed store of (embeddings, response) pairs with cosine-similarity lookup and LRU eviction"""
+
+    def __init__(self, path: str, max_entries: int = 512):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "id INTEGER PRIMARY KEY, namespace TEXT, signature TEXT, "
+            "embeddings BLOB, response TEXT, last_used REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_key ON entries (namespace, signature)")
+        self.conn.commit()
+
+    def lookup(self, namespace: str, signature: str, embeddings: np.ndarray, threshold: float) -> Optional[str]:
+        """Return the cached response whose segments are all at least `threshold` similar, if any."""
+        rows = self.conn.execute(
+            "SELECT id, embeddings, response FROM entries WHERE namespace = ? AND signature = ?",
+            (namespace, signature)
+        ).fetchall()
+        best_id, best_response, best_score = None, None, threshold
+        for entry_id, blob, response in rows:
+            cached = np.frombuffer(blob, dtype=np.float32).reshape(embeddings.shape)
+            # Every segment must match, so a single rewritten section is enough to miss
+            score = float(np.einsum("ij,ij->i", cached, embeddings).min())
+            if score >= best_score:
+                best_id, best_response, best_score = entry_id, response, score
+        if best_id is not None:
+            self.conn.execute("UPDATE entries SET last_used = ? WHERE id = ?", (time.time(), best_id))
+            self.conn.commit()
+        return best_response
+
+    def store(self, namespace: str, signature: str, embeddings: np.ndarray, response: str) -> None:
+        """Insert a response and evict the least recently used entries beyond max_entries."""
+        self.conn.execute(
+            "INSERT INTO entries (namespace, signature, embeddings, response, last_used) VALUES (?, ?, ?, ?, ?)",
+            (namespace, signature, embeddings.astype(np.float32).tobytes(), response, time.time())
+        )
+        self.conn.execute(
+            "DELETE FROM entries WHERE id NOT IN (SELECT id FROM entries ORDER BY last_used DESC LIMIT ?)",
+            (self.max_entries,)
+        )
+        self.conn.commit()
+
+@functools.lru_cache(maxsize=1)
+def get_semantic_cache() -> SemanticCache:
+    """Open the process-wide semantic cache."""
+    return SemanticCache(os.path.join(CACHE_DIR, "semantic_cache.db"))
+
+def semantic_cache(threshold: float = 0.95, context: Sequence[str] = (), validate: Optional[Callable[[str], Any]] = None):
+    """
+    Cache the completion returned by an LLM call, keyed by the embeddings of its inputs.
+
+    The positional string arguments of the decorated function are embedded and compared by
+    similarity. The keyword arguments named in `context` (for example a slide image or the
+    upstream inputs a prompt was built from) are hashed into the key and must match exactly,
+    so a near-identical prompt built on different inputs is not a hit. Other keyword
+    arguments are not part of the key and must be derived from the positional arguments.
+
+    Args:
+        threshold: Minimum cosine similarity, per input segment, for a cached completion to be reused.
+        context: Names of keyword arguments that must be identical for a cached completion to be reused.
+        validate: Called on a new completion before it is stored; completions for which it raises
+            TypeError or ValueError are returned but not cached.
+
+    Returns:
+        A decorator for coroutine functions returning the completion text.
+    """
+    def decorator(func):
+        namespace = f"{func.__module__}.{func.__qualname__}"
+
+        def key(texts, kwargs):
+            segments, signature = _segment(texts)
+            if context:
+                signature += ":" + _context_hash({name: kwargs.get(name) for name in context})
+            return segments, signature
+
+        def cached_response(signature, embeddings):
+            cached = get_semantic_cache().lookup(namespace, signature, embeddings, threshold)
+            if cached is not None:
+                cache_stats["hits"] += 1
+                print(f"Semantic cache hit for {func.__name__}")
+            else:
+                cache_stats["misses"] += 1
+            return cached
+
+        @functools.wraps(func)
+        async def wrapper(*texts: str, **kwargs) -> str:
+            if not _llm_cache_enabled:
+                return await func(*texts, **kwargs)
+            segments, signature = key(texts, kwargs)
+            embeddings = await embed(segments)
+
+            cached = cached_response(signature, embeddings)
+            if cached is not None:
+                return cached
+
+            response = await func(*texts, **kwargs)
+            if _is_valid(response, validate):
+                get_semantic_cache().store(namespace, signature, embeddings, response)
+            return response
+
+        return wrapper
+    return decorator
+
+def exact_cache_key(request: Dict[str, Any]) -> str:
+    """
+    Hash a chat completion request, including its model, messages and response schema.
+
+    Args:
+        request: Keyword arguments of the completions call. A Pydantic response_format is
+            replaced by its JSON schema, so changing the schema invalidates the entry.
+
+    Returns:
+        A hex digest identifying the request.
+    """
+    response_format = request.get("response_format")
+    if hasattr(response_format, "model_json_schema"):
+        request = {**request, "response_format": response_format.model_json_schema()}
+    return hashlib.blake2b(dumps_json(request)).hexdigest()
+
+async def exact_completion_async(create, validate: Optional[Callable[[str], Any]] = None, **request) -> str:
+    """
+    Return the completion text of a deterministic request, reusing the stored answer to an identical request.
+
+    The request itself waits for a slot of the running loop.
+
+    Args:
+        create: The async client method to call, e.g. client.chat.completions.create.
+        validate: Called on a new completion before it is stored, as in semantic_cache.
+        **request: Keyword arguments passed to create.
+
+    Returns:
+        The content of the first choice.
+    """
+    cache = get_disk_cache("llm_exact") if _llm_cache_enabled else None
+    key = exact_cache_key(request)
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            print(f"Exact cache hit for {request.get('model')}")
+            return cached
+
+    async with request_slot():
+        response = await create(**request)
+    content = response.choices[0].message.content
+    # A truncated or malformed answer would otherwise be replayed on every rerun
+    if cache is not None and response.choices[0].finish_reason == "stop" and _is_valid(content, validate):
+        cache.set(key, content)
+    return content
@@ -1,203 +1,448 @@
+"""
+Search PubMed through the NCBI E-utilities and save the matching records.
+
+Run from the repository root with `python -m agents.pubmed_agent`.
+"""
 import os
 import json
-import requests
-from typing import Dict, List, Any
-import time
+import random
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Any, Optional
+
+import httpx
+
+from agents._io import loads_json, write_json
+from agents._http import HTTP2_AVAILABLE
+from agents.cache import get_disk_cache
+
+# NCBI E-utilities base URL
+BASE_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
+
+# NCBI accepts up to 200 IDs per efetch GET request
+FETCH_BATCH_SIZE = 200
 
-def search_pubmed(query: str, max_results: int = 100) -> List[Dict[str, Any]]:
+# Search results and per-PMID records are cached on disk for a week
+PUBMED_CACHE_EXPIRE = 7 * 86400
+
+# Transient NCBI failures (throttling, overloaded servers, dropped connections) are retried
+# up to MAX_ATTEMPTS times with jittered exponential backoff between RETRY_MIN_WAIT and RETRY_MAX_WAIT seconds
+MAX_ATTEMPTS = 5
+RETRY_MIN_WAIT = 0.5
+RETRY_MAX_WAIT = 8.0
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+class AsyncRateLimiter:
+    """Spaces out request starts so that at most `rate` requests begin per `period` seconds"""
+    
+    def __init__(self, rate: int, period: float = 1.0):
+        self.interval = period / rate
+        self._next_start = 0.0
+    
+    async def __aenter__(self):
+        # Reserve the next free start slot before awaiting, so concurrent callers queue up in order
+        now = asyncio.get_running_loop().time()
+        start = max(now, self._next_start)
+        self._next_start = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+def _retry_delay(attempt: int, error: Exception) -> float:
+    """Seconds to wait before the next attempt: the server's Retry-After if given, else jittered exponential backoff."""
+    if isinstance(error, httpx.HTTPStatusError):
+        retry_after = error.response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), RETRY_MAX_WAIT)
+    return min(RETRY_MIN_WAIT * 2 ** attempt, RETRY_MAX_WAIT) * random.uniform(0.5, 1.0)
+
+async def _with_retry(request):
     """
-    Search PubMed for papers matching the query and retrieve full information including abstracts.
+    Await request(), retrying on transient HTTP failures.
     
     Args:
-        query: The search query string.
-        max_results: Maximum number of results to retrieve.
+        request: Zero-argument coroutine function performing one attempt. It must raise
+            httpx.HTTPStatusError (via raise_for_status) on error responses.
         
     Returns:
-        A list of dictionaries containing paper information.
+        The result of the first successful attempt.
     """
-    # NCBI E-utilities base URL
-    base_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
-    
-    # Step 1: Search for IDs matching the query
-    search_url = f"{base_url}esearch.fcgi"
-    search_params = {
-        "db": "pubmed",
-        "term": query,
-        "retmax": max_results,
-        "retmode": "json",
-        "sort": "relevance"
-    }
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            return await request()
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            retryable = isinstance(e, httpx.TransportError) or e.response.status_code in RETRY_STATUS_CODES
+            if not retryable or attempt == MAX_ATTEMPTS - 1:
+                raise
+            delay = _retry_delay(attempt, e)
+            print(f"NCBI request failed ({e}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+async def _get(client: httpx.AsyncClient, limiter: AsyncRateLimiter, url: str, params: Dict[str, Any]) -> httpx.Response:
+    """Rate-limited GET that raises on error responses, retried on transient failures."""
+    async def attempt():
+        async with limiter:
+            response = await client.get(url, params=params)
+        response.raise_for_status()
+        return response
+    
+    return await _with_retry(attempt)
+
+def _element_text(element: Optional[ET.Element]) -> str:
+    """Return the full text of an element, including text nested in inline markup such as <i> or <sup>."""
+    if element is None:
+        return ""
+    return "".join(element.itertext()).strip()
+
+def _parse_article(article: ET.Element) -> Optional[Dict[str, Any]]:
+    """
+    Extract paper details from a single <PubmedArticle> element.
+    
+    Args:
+        article: The parsed <PubmedArticle> element.
+        
+    Returns:
+        A dictionary containing paper information, or None if the record has no PMID.
+    """
+    citation = article.find("MedlineCitation")
+    if citation is None:
+        return None
+    
+    # Extract PMID (the first one; PMIDs of cited or corrected papers appear further down)
+    pmid = citation.findtext("PMID", "").strip()
+    if not pmid:
+        return None
+    
+    details = citation.find("Article")
+    if details is None:
+        details = ET.Element("Article")
+    
+    # Extract title
+    title = _element_text(details.find("ArticleTitle")) or "Title not available"
+    
+    # Extract abstract, joining structured abstracts (BACKGROUND, METHODS, ...) section by section
+    sections = []
+    for section in details.iterfind("Abstract/AbstractText"):
+        text = _element_text(section)
+        label = section.get("Label")
+        if text:
+            sections.append(f"{label}: {text}" if label else text)
+    abstract = "\n".join(sections) or "Abstract not available"
+    
+    # Extract authors
+    authors = []
+    for author in details.iterfind("AuthorList/Author"):
+        last_name = author.findtext("LastName", "").strip()
+        first_name = author.findtext("ForeName", "").strip()
+        if last_name or first_name:
+            authors.append(f"{last_name}{', ' + first_name if first_name else ''}")
+    
+    # Extract year, falling back to the free-text MedlineDate (e.g. "2019 Nov-Dec")
+    pub_date = details.find("Journal/JournalIssue/PubDate")
+    year = "Year not available"
+    if pub_date is not None:
+        year = pub_date.findtext("Year", "").strip() or pub_date.findtext("MedlineDate", "").strip()[:4] or year
     
-    search_response = requests.get(search_url, params=search_params)
-    search_data = search_response.json()
+    # Extract journal
+    journal = details.findtext("Journal/Title", "").strip() or "Journal not available"
     
-    if "esearchresult" not in search_data or "idlist" not in search_data["esearchresult"]:
-        print("No results found or API response format unexpected")
-        return []
+    return {
+        "pmid": pmid,
+        "title": title,
+        "authors": authors,
+        "year": year,
+        "journal": journal,
+        "abstract": abstract
+    }
+
+def _read_articles(parser: ET.XMLPullParser) -> List[Dict[str, Any]]:
+    """
+    Extract paper details from the <PubmedArticle> elements completed so far by a pull parser.
     
-    id_list = search_data["esearchresult"]["idlist"]
+    Args:
+        parser: Pull parser fed with (part of) an efetch XML response.
+        
+    Returns:
+        A list of dictionaries containing paper information.
+    """
+    papers = []
     
-    if not id_list:
-        print("No papers found matching the query")
-        return []
+    for _, element in parser.read_events():
+        if element.tag != "PubmedArticle":
+            continue
+        paper = _parse_article(element)
+        if paper is not None:
+            papers.append(paper)
+        # Release the parsed subtree
+        element.clear()
     
-    # Step 2: Fetch detailed information for each paper ID
-    fetch_url = f"{base_url}efetch.fcgi"
+    return papers
+
+def _feed_articles(parser: ET.XMLPullParser, chunk: bytes) -> List[Dict[str, Any]]:
+    """Feed a chunk of the response to the parser and extract the articles it completed."""
+    parser.feed(chunk)
+    return _read_articles(parser)
+
+def _close_articles(parser: ET.XMLPullParser) -> List[Dict[str, Any]]:
+    """Finish parsing and extract any remaining articles."""
+    parser.close()
+    return _read_articles(parser)
+
+async def _fetch_batch(client: httpx.AsyncClient, limiter: AsyncRateLimiter, executor: ThreadPoolExecutor, batch_ids: List[str], batch_number: int, base_params: Dict[str, str]) -> Optional[List[Dict[str, Any]]]:
+    """
+    Fetch and parse one batch of PubMed records.
+    
+    Args:
+        client: Shared HTTP client.
+        limiter: Rate limiter shared by all requests of the search.
+        executor: Worker pool that parses responses off the event loop.
+        batch_ids: PubMed IDs to fetch.
+        batch_number: 1-based batch index, used in error messages.
+        base_params: Parameters sent with every E-utilities request.
+        
+    Returns:
+        A list of dictionaries containing paper information, or None if the batch failed.
+    """
     fetch_params = {
-        "db": "pubmed",
-        "id": ",".join(id_list),
+        **base_params,
+        "id": ",".join(batch_ids),
         "retmode": "xml",
         "rettype": "abstract"  # Explicitly request abstracts
     }
     
-    papers = []
-    
-    # To avoid overwhelming the API, we'll fetch in smaller batches if needed
-    batch_size = 20
-    for i in range(0, len(id_list), batch_size):
-        batch_ids = id_list[i:i+batch_size]
-        fetch_params["id"] = ",".join(batch_ids)
+    async def attempt():
+        # A retried batch restarts from an empty parser, so a dropped stream never yields partial results
+        papers = []
+        loop = asyncio.get_running_loop()
+        parser = ET.XMLPullParser(events=("end",))
         
-        try:
-            fetch_response = requests.get(fetch_url, params=fetch_params)
-            
-            if fetch_response.status_code != 200:
-                print(f"Error fetching details for batch {i//batch_size + 1}: {fetch_response.status_code}")
-                continue
-                
-            # Parse XML response to extract paper details
-            xml_content = fetch_response.text
-            
-            # Process each PubmedArticle entry
-            article_start_indices = [i for i in range(len(xml_content)) if xml_content.startswith("<PubmedArticle>", i)]
-            
-            for idx, start_idx in enumerate(article_start_indices):
-                end_idx = xml_content.find("</PubmedArticle>", start_idx) + len("</PubmedArticle>")
-                article_xml = xml_content[start_idx:end_idx]
-                
-                # Extract PMID
-                pmid_start = article_xml.find("<PMID Version=")
-                if pmid_start == -1:
-                    pmid_start = article_xml.find("<PMID>")
-                    if pmid_start == -1:
-                        continue
-                    pmid_start += len("<PMID>")
-                else:
-                    pmid_start = article_xml.find(">", pmid_start) + 1
-                
-                pmid_end = article_xml.find("</PMID>", pmid_start)
-                pmid = article_xml[pmid_start:pmid_end].strip()
-                
-                # Extract title
-                title_start = article_xml.find("<ArticleTitle>")
-                title = "Title not available"
-                if title_start != -1:
-                    title_start += len("<ArticleTitle>")
-                    title_end = article_xml.find("</ArticleTitle>", title_start)
-                    title = article_xml[title_start:title_end].strip()
+        async with limiter:
+            # Stream the (gzip-encoded, decoded by httpx) response straight into the XML parser,
+            # so articles are parsed while the rest of the batch is still downloading
+            async with client.stream("GET", f"{BASE_URL}efetch.fcgi", params=fetch_params) as fetch_response:
+                fetch_response.raise_for_status()
                 
-                # Extract abstract
-                abstract = "Abstract not available"
-                abstract_start = article_xml.find("<AbstractText")
-                if abstract_start != -1:
-                    # Handle potential attributes in the AbstractText tag
-                    abstract_start = article_xml.find(">", abstract_start) + 1
-                    abstract_end = article_xml.find("</AbstractText>", abstract_start)
-                    abstract = article_xml[abstract_start:abstract_end].strip()
-                
-                # Extract authors
-                authors = []
-                author_list_start = article_xml.find("<AuthorList")
-                if author_list_start != -1:
-                    author_list_end = article_xml.find("</AuthorList>", author_list_start)
-                    author_list = article_xml[author_list_start:author_list_end]
-                    
-                    author_start_indices = [i for i in range(len(author_list)) if author_list.startswith("<Author ", i) or author_list.startswith("<Author>", i)]
-                    
-                    for author_idx in author_start_indices:
-                        author_end = author_list.find("</Author>", author_idx)
-                        author_xml = author_list[author_idx:author_end]
-                        
-                        last_name = ""
-                        last_name_start = author_xml.find("<LastName>")
-                        if last_name_start != -1:
-                            last_name_start += len("<LastName>")
-                            last_name_end = author_xml.find("</LastName>", last_name_start)
-                            last_name = author_xml[last_name_start:last_name_end].strip()
-                        
-                        first_name = ""
-                        first_name_start = author_xml.find("<ForeName>")
-                        if first_name_start != -1:
-                            first_name_start += len("<ForeName>")
-                            first_name_end = author_xml.find("</ForeName>", first_name_start)
-                            first_name = author_xml[first_name_start:first_name_end].strip()
-                        
-                        if last_name or first_name:
-                            authors.append(f"{last_name}{', ' + first_name if first_name else ''}")
-                
-                # Extract year
-                year = "Year not available"
-                year_start = article_xml.find("<PubDate>")
-                if year_start != -1:
-                    year_tag_start = article_xml.find("<Year>", year_start)
-                    if year_tag_start != -1:
-                        year_start = year_tag_start + len("<Year>")
-                        year_end = article_xml.find("</Year>", year_start)
-                        year = article_xml[year_start:year_end].strip()
-                
-                # Extract journal
-                journal = "Journal not available"
-                journal_start = article_xml.find("<Journal>")
-                if journal_start != -1:
-                    title_start = article_xml.find("<Title>", journal_start)
-                    if title_start != -1:
-                        title_start += len("<Title>")
-                        title_end = article_xml.find("</Title>", title_start)
-                        journal = article_xml[title_start:title_end].strip()
-                
-                paper = {
-                    "pmid": pmid,
-                    "title": title,
-                    "authors": authors,
-                    "year": year,
-                    "journal": journal,
-                    "abstract": abstract
-                }
-                
-                papers.append(paper)
-            
-            # Be nice to the API with a short delay between batches
-            time.sleep(1)
-            
-        except Exception as e:
-            print(f"Error processing batch {i//batch_size + 1}: {str(e)}")
+                # Parse XML response to extract paper details. Parsing runs in the worker pool, so
+                # the event loop keeps receiving the other batches while this one is parsed
+                async for chunk in fetch_response.aiter_bytes():
+                    papers.extend(await loop.run_in_executor(executor, _feed_articles, parser, chunk))
+        
+        papers.extend(await loop.run_in_executor(executor, _close_articles, parser))
+        return papers
+    
+    try:
+        return await _with_retry(attempt)
+    
+    except httpx.HTTPStatusError as e:
+        print(f"Error fetching details for batch {batch_number}: {e.response.status_code}")
+        return None
+    
+    except Exception as e:
+        print(f"Error processing batch {batch_number}: {str(e)}")
+        return None
+
+def _parse_summary(summary: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Convert one esummary JSON record into the paper format used for efetch records.
+    
+    Args:
+        summary: The esummary record of a single PMID.
+        
+    Returns:
+        A dictionary containing paper information, without the abstract.
+    """
+    # esummary reports authors as "Last Initials"; reformat them as "Last, Initials" like efetch records
+    authors = []
+    for author in summary.get("authors", []):
+        name = author.get("name", "").strip()
+        if name and author.get("authtype", "Author") == "Author":
+            last_name, _, initials = name.rpartition(" ")
+            authors.append(f"{last_name}, {initials}" if last_name else initials)
+    
+    return {
+        "pmid": summary["uid"],
+        "title": summary.get("title") or "Title not available",
+        "authors": authors,
+        "year": summary.get("pubdate", "")[:4] or "Year not available",
+        "journal": summary.get("fulljournalname") or summary.get("source") or "Journal not available"
+    }
+
+async def _fetch_summaries(client: httpx.AsyncClient, limiter: AsyncRateLimiter, executor: ThreadPoolExecutor, batch_ids: List[str], batch_number: int, base_params: Dict[str, str]) -> Optional[List[Dict[str, Any]]]:
+    """
+    Fetch one batch of PubMed metadata (no abstracts) as compact esummary JSON.
+    
+    Args:
+        client: Shared HTTP client.
+        limiter: Rate limiter shared by all requests of the search.
+        executor: Worker pool that parses responses off the event loop.
+        batch_ids: PubMed IDs to fetch.
+        batch_number: 1-based batch index, used in error messages.
+        base_params: Parameters sent with every E-utilities request.
+        
+    Returns:
+        A list of dictionaries containing paper information, or None if the batch failed.
+    """
+    summary_params = {
+        **base_params,
+        "id": ",".join(batch_ids),
+        "retmode": "json"
+    }
+    
+    try:
+        summary_response = await _get(client, limiter, f"{BASE_URL}esummary.fcgi", summary_params)
+        summary_data = await asyncio.get_running_loop().run_in_executor(executor, loads_json, summary_response.content)
+        result = summary_data.get("result", {})
+        return [_parse_summary(result[pmid]) for pmid in result.get("uids", []) if "error" not in result[pmid]]
+    
+    except httpx.HTTPStatusError as e:
+        print(f"Error fetching summaries for batch {batch_number}: {e.response.status_code}")
+        return None
+    
+    except Exception as e:
+        print(f"Error processing batch {batch_number}: {str(e)}")
+        return None
+
+async def search_pubmed_async(query: str, max_results: int = 100, fetch_abstracts: bool = True) -> List[Dict[str, Any]]:
+    """
+    Search PubMed for papers matching the query and retrieve full information including abstracts.
+    
+    Batches are fetched concurrently over one connection, throttled to NCBI's rate limit
+    (3 requests/s, or 10 requests/s when NCBI_API_KEY is set), and throttled or failed
+    requests are retried with backoff. Complete results are cached on disk per (query,
+    max_results, fetch_abstracts), and full records already fetched for any earlier query
+    are reused so only new PMIDs are requested.
+    
+    Args:
+        query: The search query string.
+        max_results: Maximum number of results to retrieve.
+        fetch_abstracts: Fetch full efetch records including abstracts. When False, only
+            title, authors, year and journal are retrieved through the lighter esummary endpoint.
+        
+    Returns:
+        A list of dictionaries containing paper information.
+    """
+    search_cache = get_disk_cache("pubmed_searches")
+    cache_key = json.dumps([query, max_results, fetch_abstracts])
+    cached_papers = search_cache.get(cache_key)
+    if cached_papers is not None:
+        print("Using cached PubMed results for this query")
+        return cached_papers
+    
+    base_params = {"db": "pubmed"}
+    api_key = os.getenv("NCBI_API_KEY")
+    if api_key:
+        base_params["api_key"] = api_key
+    limiter = AsyncRateLimiter(10 if api_key else 3)
+    
+    async with httpx.AsyncClient(http2=HTTP2_AVAILABLE, timeout=30, headers={"Accept-Encoding": "gzip"}) as client:
+        # Step 1: Search for IDs matching the query
+        search_params = {
+            **base_params,
+            "term": query,
+            "retmax": max_results,
+            "retmode": "json",
+            "sort": "relevance"
+        }
+        
+        search_response = await _get(client, limiter, f"{BASE_URL}esearch.fcgi", search_params)
+        search_data = loads_json(search_response.content)
+        
+        if "esearchresult" not in search_data or "idlist" not in search_data["esearchresult"]:
+            print("No results found or API response format unexpected")
+            return []
+        
+        id_list = search_data["esearchresult"]["idlist"]
+        
+        if not id_list:
+            print("No papers found matching the query")
+            return []
+        
+        # Step 2: Fetch detailed information for the paper IDs not already cached.
+        # efetch records already carry all metadata, so esummary is only used when abstracts are not needed
+        record_cache = get_disk_cache("pubmed_records")
+        records = record_cache.get_many(id_list)
+        new_ids = [pmid for pmid in id_list if pmid not in records]
+        
+        fetch = _fetch_batch if fetch_abstracts else _fetch_summaries
+        batches = [new_ids[i:i + FETCH_BATCH_SIZE] for i in range(0, len(new_ids), FETCH_BATCH_SIZE)]
+        # The pool lives for one search; batches are parsed in parallel threads as they stream in
+        with ThreadPoolExecutor(max_workers=max(1, min(len(batches), os.cpu_count() or 1))) as executor:
+            results = await asyncio.gather(*[
+                fetch(client, limiter, executor, batch_ids, batch_number + 1, base_params)
+                for batch_number, batch_ids in enumerate(batches)
+            ])
+    
+    fetched = {paper["pmid"]: paper for batch_papers in results if batch_papers for paper in batch_papers}
+    # Only full records go into the per-PMID cache, since summaries lack abstracts
+    if fetch_abstracts:
+        record_cache.set_many(fetched, expire=PUBMED_CACHE_EXPIRE)
+    records.update(fetched)
+    
+    papers = [records[pmid] for pmid in id_list if pmid in records]
+    
+    # Only cache complete result sets
+    if all(batch_papers is not None for batch_papers in results):
+        search_cache.set(cache_key, papers, expire=PUBMED_CACHE_EXPIRE)
     
     return papers
 
-def run_pubmed_agent(query: str, output_path: str) -> str:
+def search_pubmed(query: str, max_results: int = 100, fetch_abstracts: bool = True) -> List[Dict[str, Any]]:
     """
-    Run the PubMed search agent and save results to a JSON file.
+    Search PubMed for papers matching the query and retrieve full information including abstracts.
+    
+    Args:
+        query: The search query string.
+        max_results: Maximum number of results to retrieve.
+        fetch_abstracts: Fetch abstracts as well as metadata.
+        
+    Returns:
+        A list of dictionaries containing paper information.
+    """
+    return asyncio.run(search_pubmed_async(query, max_results, fetch_abstracts))
+
+async def run_pubmed_agent_async(query: str, output_path: str, fetch_abstracts: bool = True, pretty: bool = False) -> str:
+    """
+    Run the PubMed search agent inside an event loop and save results to a JSON file.
     
     Args:
         query: The search query string.
         output_path: Path to save the JSON results.
+        fetch_abstracts: Fetch abstracts as well as metadata.
+        pretty: Indent the saved JSON for human reading.
         
     Returns:
         Path to the saved JSON file.
     """
     print(f"Searching PubMed for: {query}")
-    papers = search_pubmed(query)
+    papers = await search_pubmed_async(query, fetch_abstracts=fetch_abstracts)
     
     # Create output directory if it doesn't exist
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
     
     # Save results to JSON file
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(papers, f, indent=2, ensure_ascii=False)
+    write_json(papers, output_path, pretty=pretty)
     
     print(f"Found {len(papers)} papers matching the query. Results saved to {output_path}")
     return output_path
 
+def run_pubmed_agent(query: str, output_path: str, fetch_abstracts: bool = True, pretty: bool = False) -> str:
+    """
+    Run the PubMed search agent and save results to a JSON file.
+    
+    Args:
+        query: The search query string.
+        output_path: Path to save the JSON results.
+        fetch_abstracts: Fetch abstracts as well as metadata.
+        pretty: Indent the saved JSON for human reading.
+        
+    Returns:
+        Path to the saved JSON file.
+    """
+    return asyncio.run(run_pubmed_agent_async(query, output_path, fetch_abstracts, pretty))
+
 if __name__ == "__main__":
     # Test the agent
     test_query = "Maria Luisa Gorno-Tempini AND PPA"
@@ -1,50 +1,63 @@
+"""
+Insert [REF] markers after the claims of a manuscript that need a citation.
+
+Run from the repository root with `python -m agents.reference_marking_agent`.
+"""
 import os
-from openai import AzureOpenAI
+import asyncio
 from typing import Dict, Any
 
-def insert_reference_markers(article_text: str, output_path: str) -> str:
+from agents._io import read_text_async
+from agents._llm_client import get_async_client
+from agents.cache import exact_completion_async
+
+MARKING_INSTRUCTIONS = """You will be provided with a scientific manuscript. Your task is to carefully read the provided text and insert "[REF]" immediately following claims or statements that clearly requires a citation. Do not make any modifications to the wording, punctuation, or formatting of the original text. 
+
+Example:
+Original:
+"Recent studies suggest a significant correlation between sleep and memory consolidation."
+
+Modified:
+"Recent studies suggest a significant correlation between sleep and memory consolidation [REF]."
+
+Return only the full manuscript with the inserted markers."""
+
+async def _request_markers(article_text: str) -> str:
     """
-    Insert [REF] markers where citations are needed in the article.
+    Ask the model to insert [REF] markers into the article.
     
     Args:
         article_text: The perspective article text.
-        output_path: Path to save the marked article.
         
     Returns:
-        Path to the saved marked article file.
+        The article text with [REF] markers.
     """
-    client = AzureOpenAI(
-        api_key=os.environ["VERSA_OPENAI_API_KEY"],
-        api_version=os.environ['VERSA_API_VERSION'],
-        azure_endpoint=os.environ['VERSA_RESOURCE_ENDPOINT']
-    )
+    client = get_async_client()
     
-    prompt = f"""
-    You will be provided with a scientific manuscript. Your task is to carefully read the provided text and insert "[REF]" immediately following claims or statements that clearly requires a citation. Do not make any modifications to the wording, punctuation, or formatting of the original text. 
-
-    Example:
-    Original:
-    "Recent studies suggest a significant correlation between sleep and memory consolidation."
-
-    Modified:
-    "Recent studies suggest a significant correlation between sleep and memory consolidation [REF]."
+    # The marked article reproduces its input verbatim, so only an identical manuscript can reuse a completion
+    return await exact_completion_async(
+        client.chat.completions.create,
+        model="gpt-4o-2024-08-06", #"o1-mini-2024-09-12",
+        messages=[
+            {"role": "system", "content": MARKING_INSTRUCTIONS},
+            {"role": "user", "content": article_text}
+        ]
+    )
 
-    Here is the scientific manuscript:
-    
-    {article_text}
+async def insert_reference_markers_async(article_text: str, output_path: str) -> str:
     """
+    Insert [REF] markers where citations are needed in the article.
     
+    Args:
+        article_text: The perspective article text.
+        output_path: Path to save the marked article.
+        
+    Returns:
+        Path to the saved marked article file.
+    """
     print("Inserting reference markers into perspective article")
     
-    response = client.beta.chat.completions.parse(
-        model="gpt-4o-2024-08-06", #"o1-mini-2024-09-12",
-        messages=[
-            {"role": "user", "content": prompt}
-        ],
-        response_format=ArticleReview
-    )
-    
-    marked_article = response.choices[0].message.content
+    marked_article = await _request_markers(article_text)
     
     # Create output directory if it doesn't exist
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
@@ -56,9 +69,22 @@ def insert_reference_markers(article_text: str, output_path: str) -> str:
     print(f"Reference markers inserted and saved to {output_path}")
     return output_path
 
-def run_reference_marking_agent(article_path: str, output_path: str) -> str:
+def insert_reference_markers(article_text: str, output_path: str) -> str:
     """
-    Run the reference marking agent.
+    Insert [REF] markers where citations are needed in the article.
+    
+    Args:
+        article_text: The perspective article text.
+        output_path: Path to save the marked article.
+        
+    Returns:
+        Path to the saved marked article file.
+    """
+    return asyncio.run(insert_reference_markers_async(article_text, output_path))
+
+async def run_reference_marking_agent_async(article_path: str, output_path: str) -> str:
+    """
+    Run the reference marking agent inside an event loop.
     
     Args:
         article_path: Path to the perspective article file.
@@ -68,10 +94,22 @@ def run_reference_marking_agent(article_path: str, output_path: str) -> str:
         Path to the saved marked article file.
     """
     # Read the article
-    with open(article_path, 'r', encoding='utf-8') as f:
-        article_text = f.read()
+    article_text = await read_text_async(article_path)
     
-    return insert_reference_markers(article_text, output_path)
+    return await insert_reference_markers_async(article_text, output_path)
+
+def run_reference_marking_agent(article_path: str, output_path: str) -> str:
+    """
+    Run the reference marking agent.
+    
+    Args:
+        article_path: Path to the perspective article file.
+        output_path: Path to save the marked article.
+        
+    Returns:
+        Path to the saved marked article file.
+    """
+    return asyncio.run(run_reference_marking_agent_async(article_path, output_path))
 
 if __name__ == "__main__":
     # Test the agent
@@ -1,53 +1,181 @@
+"""
+Replace the [REF] markers of a manuscript with citations from the PubMed results.
+
+Run from the repository root with `python -m agents.reference_matching_agent`.
+"""
 import os
+import re
 import json
-from openai import AzureOpenAI
+import asyncio
 from typing import Dict, Any, List
 
-def match_references(marked_article: str, references_json: List[Dict[str, Any]], output_path: str) -> str:
+from agents._io import read_json, read_text_async
+from agents._llm_client import get_async_client
+from agents.cache import exact_completion_async
+from agents.retrieval import BM25, tokenize, split_sentences, reference_text, references_for_prompt
+from agents.schema import SentenceReferenceMatches, SENTENCE_MATCHES_FORMAT
+
+# Number of BM25-ranked candidate references sent with each [REF] sentence
+CANDIDATES_PER_SENTENCE = 20
+
+# Sentences of surrounding text sent on each side of a [REF] sentence
+CONTEXT_SENTENCES = 2
+
+# At most this many references are cited for a single marker
+MAX_REFERENCES_PER_MARKER = 3
+
+MARKER = "[REF]"
+
+MATCHING_INSTRUCTIONS = """You will receive a passage from a scientific manuscript (CONTEXT), one sentence of that passage containing one or more "[REF]" markers (TARGET SENTENCE), and a list of candidate references (CANDIDATE REFERENCES, JSON format).
+
+For each "[REF]" marker in the target sentence, in order of appearance, select the candidate references that best support the claim the marker follows, carefully considering the context and relevance of each reference to the statement it supports. Cite at most 3 references per marker, and fewer if one reference is clearly the best match. Only use references from the candidate list, identified by their PMID. If no candidate supports the claim, return an empty list for that marker."""
+
+def _initials(given_names: str) -> str:
+    """APA initials from a forename ("Maria Luisa") or PubMed initials ("ML")"""
+    if given_names.isupper() and " " not in given_names:
+        parts = list(given_names)
+    else:
+        parts = [part for part in re.split(r"[\s.]+", given_names) if part]
+    return " ".join(f"{part[0]}." for part in parts)
+
+def _last_name(author: str) -> str:
+    """Surname of an author stored as "Last, Given" """
+    return author.partition(", ")[0]
+
+def format_in_text(reference: Dict[str, Any]) -> str:
     """
-    Match reference markers in the article with references from the JSON file.
+    Format the APA in-text citation of a reference, without parentheses.
     
     Args:
-        marked_article: The article text with [REF] markers.
-        references_json: List of references from PubMed.
-        output_path: Path to save the article with matched references.
+        reference: A PubMed record.
         
     Returns:
-        Path to the saved article file with matched references.
+        The citation, e.g. "Smith & Doe, 2020" or "Smith et al., 2020".
     """
-    client = AzureOpenAI(
-        api_key=os.environ["VERSA_OPENAI_API_KEY"],
-        api_version=os.environ['VERSA_API_VERSION'],
-        azure_endpoint=os.environ['VERSA_RESOURCE_ENDPOINT']
-    )
-    
-    # Convert references to string for prompt
-    references_str = json.dumps(references_json, indent=2)
-    
-    prompt = f"""
-    You will receive a JSON file containing a list of references. Your task is to accurately match and allocate the references from this JSON file to each "[REF]" marker previously inserted into the manuscript. Ensure that each inserted "[REF]" is associated with the most appropriate reference from the provided list, carefully considering the context and relevance of each reference to the statement it supports. Only use references provided in the JSON file. If no matching reference is found for a particular "[REF]" marker, leave it as "[REF not found]". The citations should be formatted in APA Style with in-text citations and reference list.
+    authors = [_last_name(author) for author in reference.get("authors", [])]
+    if not authors:
+        names = reference.get("title", "Anonymous")
+    elif len(authors) == 1:
+        names = authors[0]
+    elif len(authors) == 2:
+        names = f"{authors[0]} & {authors[1]}"
+    else:
+        names = f"{authors[0]} et al."
+    return f"{names}, {reference.get('year', 'n.d.')}"
 
-    Here is the manuscript with [REF] markers:
+def format_reference(reference: Dict[str, Any]) -> str:
+    """
+    Format the APA reference list entry of a reference.
     
-    {marked_article}
+    Args:
+        reference: A PubMed record.
+        
+    Returns:
+        The reference list entry.
+    """
+    authors = []
+    for author in reference.get("authors", []):
+        last_name, _, given_names = author.partition(", ")
+        authors.append(f"{last_name}, {_initials(given_names)}" if given_names else last_name)
     
-    Here are the available references (JSON format):
+    # APA lists up to 20 authors; longer lists keep the first 19, an ellipsis and the last author
+    if len(authors) > 20:
+        author_str = ", ".join(authors[:19]) + ", ... " + authors[-1]
+    elif len(authors) > 1:
+        author_str = ", ".join(authors[:-1]) + ", & " + authors[-1]
+    else:
+        author_str = "".join(authors)
     
-    {references_str}
+    title = reference.get("title", "").strip()
+    if title and title[-1] not in ".?!":
+        title += "."
+    return f"{author_str} ({reference.get('year', 'n.d.')}). {title} {reference.get('journal', '')}.".strip()
+
+async def _request_sentence_matches(context: str, sentence: str, candidates: List[Dict[str, Any]]) -> SentenceReferenceMatches:
     """
+    Ask the model to choose references for the [REF] markers of one sentence.
     
-    print("Matching references to citation markers")
+    Args:
+        context: The sentence with its surrounding sentences.
+        sentence: The sentence containing the markers.
+        candidates: Pre-filtered candidate references.
+        
+    Returns:
+        The PMIDs chosen for each marker of the sentence.
+    """
+    client = get_async_client()
     
-    response = client.chat.completions.create(
-        model="o1-2024-12-17",
+    content = await exact_completion_async(
+        client.chat.completions.create,
+        validate=SentenceReferenceMatches.model_validate_json,
+        model="gpt-4o-2024-08-06",
         messages=[
-            {"role": "user", "content": prompt}
+            {"role": "system", "content": MATCHING_INSTRUCTIONS},
+            {"role": "user", "content": (
+                f"CONTEXT:\n\n{context}\n\n"
+                f"TARGET SENTENCE:\n\n{sentence}\n\n"
+                # Citations are formatted locally from the full records, so three authors are enough to identify a paper
+                f"CANDIDATE REFERENCES:\n\n{references_for_prompt(candidates, max_authors=3)}"
+            )}
         ],
-        reasoning_effort="high"
+        response_format=SENTENCE_MATCHES_FORMAT
     )
-    
-    article_with_references = response.choices[0].message.content
+    return SentenceReferenceMatches.model_validate_json(content)
 
+async def match_references_async(marked_article: str, references_json: List[Dict[str, Any]], output_path: str) -> str:
+    """
+    Match reference markers in the article with references from the JSON file.
+    
+    Each sentence containing [REF] markers is matched in its own small request, with
+    its neighbouring sentences as context and only the BM25 top candidates among the
+    references. The requests run concurrently, and the chosen references are formatted
+    in APA style locally and merged back into the article.
+    
+    Args:
+        marked_article: The article text with [REF] markers.
+        references_json: List of references from PubMed.
+        output_path: Path to save the article with matched references.
+        
+    Returns:
+        Path to the saved article file with matched references.
+    """
+    print("Matching references to citation markers")
+    
+    references_by_pmid = {reference["pmid"]: reference for reference in references_json}
+    index = BM25([tokenize(reference_text(reference)) for reference in references_json])
+    
+    sentences = split_sentences(marked_article)
+    marked = [i for i, sentence in enumerate(sentences) if MARKER in sentence]
+    
+    async def match_sentence(i: int) -> List[List[str]]:
+        sentence = sentences[i]
+        context = " ".join(sentences[max(0, i - CONTEXT_SENTENCES):i + CONTEXT_SENTENCES + 1])
+        candidates = [references_json[j] for j in index.top_k(tokenize(context), CANDIDATES_PER_SENTENCE)]
+        result = await _request_sentence_matches(context, sentence, candidates)
+        
+        # Keep one entry per marker, and only PMIDs that were offered as candidates
+        allowed = {candidate["pmid"] for candidate in candidates}
+        matches = [[pmid for pmid in marker.pmids if pmid in allowed][:MAX_REFERENCES_PER_MARKER] for marker in result.markers]
+        count = sentence.count(MARKER)
+        return (matches + [[]] * count)[:count]
+    
+    sentence_matches = await asyncio.gather(*[match_sentence(i) for i in marked])
+    marker_matches = iter([marker for matches in sentence_matches for marker in matches])
+    
+    cited = {}
+    def cite(match: re.Match) -> str:
+        pmids = next(marker_matches, [])
+        if not pmids:
+            return "[REF not found]"
+        for pmid in pmids:
+            cited[pmid] = references_by_pmid[pmid]
+        return "(" + "; ".join(format_in_text(references_by_pmid[pmid]) for pmid in pmids) + ")"
+    
+    # Markers are replaced in article order, which is the order the sentence matches were collected in
+    article_with_references = re.sub(re.escape(MARKER), cite, marked_article)
+    reference_list = sorted(format_reference(reference) for reference in cited.values())
+    if reference_list:
+        article_with_references += "\n\nReferences\n\n" + "\n\n".join(reference_list) + "\n"
     
     # Create output directory if it doesn't exist
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
@@ -59,9 +187,23 @@ def match_references(marked_article: str, references_json: List[Dict[str, Any]],
     print(f"References matched and saved to {output_path}")
     return output_path
 
-def run_reference_matching_agent(marked_article_path: str, references_json_path: str, output_path: str) -> str:
+def match_references(marked_article: str, references_json: List[Dict[str, Any]], output_path: str) -> str:
     """
-    Run the reference matching agent.
+    Match reference markers in the article with references from the JSON file.
+    
+    Args:
+        marked_article: The article text with [REF] markers.
+        references_json: List of references from PubMed.
+        output_path: Path to save the article with matched references.
+        
+    Returns:
+        Path to the saved article file with matched references.
+    """
+    return asyncio.run(match_references_async(marked_article, references_json, output_path))
+
+async def run_reference_matching_agent_async(marked_article_path: str, references_json_path: str, output_path: str) -> str:
+    """
+    Run the reference matching agent inside an event loop.
     
     Args:
         marked_article_path: Path to the article with [REF] markers.
@@ -72,14 +214,26 @@ def run_reference_matching_agent(marked_article_path: str, references_json_path:
         Path to the saved article file with matched references.
     """
     # Read the marked article
-    with open(marked_article_path, 'r', encoding='utf-8') as f:
-        marked_article = f.read()
+    marked_article = await read_text_async(marked_article_path)
     
     # Read the references JSON
-    with open(references_json_path, 'r', encoding='utf-8') as f:
-        references_json = json.load(f)
+    references_json = read_json(references_json_path)
     
-    return match_references(marked_article, references_json, output_path)
+    return await match_references_async(marked_article, references_json, output_path)
+
+def run_reference_matching_agent(marked_article_path: str, references_json_path: str, output_path: str) -> str:
+    """
+    Run the reference matching agent.
+    
+    Args:
+        marked_article_path: Path to the article with [REF] markers.
+        references_json_path: Path to the JSON file with references.
+        output_path: Path to save the article with matched references.
+        
+    Returns:
+        Path to the saved article file with matched references.
+    """
+    return asyncio.run(run_reference_matching_agent_async(marked_article_path, references_json_path, output_path))
 
 if __name__ == "__main__":
     # Test the agent
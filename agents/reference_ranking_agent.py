@@ -1,78 +1,147 @@
+"""
+Extract the key sentences of a manuscript and rank the PubMed references supporting each.
+
+Run from the repository root with `python -m agents.reference_ranking_agent`.
+"""
 import os
+import re
 import json
-from openai import AzureOpenAI
+import asyncio
+import hashlib
 from typing import Dict, Any, List
-from schema import StudyExtractionResult
+from agents.schema import StudyExtractionResult, STUDY_EXTRACTION_FORMAT
+from agents._io import read_json, read_text_async
+from agents._llm_client import get_async_client
+from agents.cache import exact_completion_async
+from agents.retrieval import split_sentences, embed_texts, load_reference_embeddings, top_k_similar, references_for_prompt, sentence_windows
 
-def extract_and_rank_references(manuscript_text: str, references_json: List[Dict[str, Any]], output_path: str) -> str:
+# Candidate references retrieved locally for each manuscript sentence; the model only re-ranks these
+CANDIDATES_PER_SENTENCE = 10
+
+RANKING_INSTRUCTIONS = """You will analyze a manuscript text authored by Maria Luisa Gorno-Tempini (written in first person) to identify ALL key sentences about her work and research findings in the field of primary progressive aphasia and related language disorders. For each key sentence you identify, select the most appropriate references from the provided JSON file that best support that sentence.
+
+For each key sentence, you MUST:
+1. Extract the EXACT verbatim sentence from the manuscript without any modifications
+2. Rank up to 3 references from the provided JSON that best support this sentence - include only the most relevant references
+3. Format each reference in APA style for in-text citation and for the reference list
+
+You will receive the candidate references (CANDIDATE REFERENCES, JSON format), followed by the manuscript text to analyze (MANUSCRIPT SENTENCES; one part of the manuscript when it is long), split into numbered sentences. Each sentence is followed by the PMIDs of its candidate references, pre-selected by semantic similarity.
+
+IMPORTANT REQUIREMENTS:
+1. Be THOROUGH and COMPREHENSIVE - extract ALL significant claims, findings, and research statements throughout the manuscript text provided
+2. Since this is authored by Gorno-Tempini herself, look for sentences where she describes research findings, methodologies, discoveries, or conclusions about PPA and related disorders
+3. Include up to a MAXIMUM of 3 references per sentence, but use fewer (even just 1) if one reference is clearly the best match
+4. Make sure your JSON response is properly formatted and can be parsed
+5. Copy the sentences EXACTLY as they appear in the manuscript - do not paraphrase or modify them in any way
+6. Pay attention to statements about neuroanatomical correlates, variant classifications, diagnostic criteria, imaging findings, and treatment approaches related to PPA
+7. All references must come from the provided JSON file, chosen among the candidate PMIDs listed for that sentence
+8. Format your output as JSON that follows the schema I've provided
+9. Do not limit your extraction to a small number of sentences - be comprehensive and capture ALL significant research statements throughout the paper"""
+
+# The manuscript is analyzed in overlapping windows of about this many tokens, extracted concurrently
+WINDOW_TOKENS = 1500
+WINDOW_OVERLAP_TOKENS = 200
+
+async def _window_prompts(manuscript_text: str, references_json: List[Dict[str, Any]]):
     """
-    Extract key sentences about Maria Luisa Gorno-Tempini's work from the manuscript and
-    rank the most appropriate references from the PubMed search results.
+    Split the manuscript into windows and retrieve the most similar references for each sentence.
     
     Args:
         manuscript_text: The manuscript text to analyze
         references_json: List of references from PubMed search results
-        output_path: Path to save the extracted sentences with ranked references
         
     Returns:
-        Path to the saved file with extracted sentences and ranked references
+        One (sentences_str, references_str) pair per window: the numbered sentences, each followed
+        by the PMIDs of its candidates, and the JSON of the references that are a candidate in the window
     """
-    client = AzureOpenAI(
-        api_key=os.environ["VERSA_OPENAI_API_KEY"],
-        api_version=os.environ['VERSA_API_VERSION'],
-        azure_endpoint=os.environ['VERSA_RESOURCE_ENDPOINT']
-    )
-    
-    # Convert references to string for prompt
-    references_str = json.dumps(references_json, indent=2)
+    sentences = split_sentences(manuscript_text)
+    if not sentences or not references_json:
+        return [(manuscript_text, "[]")]
     
+    reference_embeddings, sentence_embeddings = await asyncio.gather(
+        load_reference_embeddings(references_json),
+        embed_texts(sentences)
+    )
+    neighbours = top_k_similar(sentence_embeddings, reference_embeddings, CANDIDATES_PER_SENTENCE)
     
-    prompt = f"""
-    You will analyze a manuscript text authored by Maria Luisa Gorno-Tempini (written in first person) to identify ALL key sentences about her work and research findings in the field of primary progressive aphasia and related language disorders. For each key sentence you identify, select the most appropriate references from the provided JSON file that best support that sentence.
+    windows = []
+    for window in sentence_windows(sentences, WINDOW_TOKENS, WINDOW_OVERLAP_TOKENS):
+        lines = []
+        for i in window:
+            pmids = ", ".join(references_json[j]["pmid"] for j in neighbours[i])
+            lines.append(f"[{i + 1}] {sentences[i]}\nCandidate PMIDs: {pmids}")
+        
+        used = sorted(set(neighbours[window.start:window.stop].ravel().tolist()))
+        # All authors are kept, since the model writes the APA reference list entries from them
+        windows.append(("\n\n".join(lines), references_for_prompt([references_json[j] for j in used])))
+    return windows
 
-    For each key sentence, you MUST:
-    1. Extract the EXACT verbatim sentence from the manuscript without any modifications
-    2. Rank up to 3 references from the provided JSON that best support this sentence - include only the most relevant references
-    3. Format each reference in APA style for in-text citation and for the reference list
+def _sentence_key(sentence: str) -> str:
+    """Hash of a sentence with case and whitespace normalized, used to drop duplicates from overlapping windows"""
+    return hashlib.blake2b(re.sub(r"\s+", " ", sentence).strip().lower().encode("utf-8"), digest_size=16).hexdigest()
 
-    Here is the manuscript text to analyze:
+async def _request_ranking(sentences_str: str, references_str: str) -> str:
+    """
+    Ask the model for the key sentences of a manuscript window and their best references.
     
-    {manuscript_text}
+    Args:
+        sentences_str: The numbered manuscript sentences with their candidate PMIDs
+        references_str: The candidate references, serialized as JSON
+        
+    Returns:
+        The StudyExtractionResult JSON returned by the model
+    """
+    client = get_async_client()
     
-    Here are the available references (JSON format):
+    prompt = (
+        "CANDIDATE REFERENCES:\n\n" + references_str
+        + "\n\nMANUSCRIPT SENTENCES:\n\n" + sentences_str
+    )
     
-    {references_str}
+    # Identical manuscript, references and schema give an identical request, answered from the exact cache
+    return await exact_completion_async(
+        client.chat.completions.create,
+        validate=StudyExtractionResult.model_validate_json,
+        model="gpt-4o-2024-08-06", #"o1-mini-2024-09-12",
+        messages=[
+            {"role": "system", "content": RANKING_INSTRUCTIONS},
+            {"role": "user", "content": prompt}
+        ],
+        response_format=STUDY_EXTRACTION_FORMAT
+    )
 
-    IMPORTANT REQUIREMENTS:
-    1. Be THOROUGH and COMPREHENSIVE - extract ALL significant claims, findings, and research statements throughout the entire 7-page manuscript
-    2. Since this is authored by Gorno-Tempini herself, look for sentences where she describes research findings, methodologies, discoveries, or conclusions about PPA and related disorders
-    3. Include up to a MAXIMUM of 3 references per sentence, but use fewer (even just 1) if one reference is clearly the best match
-    4. Make sure your JSON response is properly formatted and can be parsed
-    5. Copy the sentences EXACTLY as they appear in the manuscript - do not paraphrase or modify them in any way
-    6. Pay attention to statements about neuroanatomical correlates, variant classifications, diagnostic criteria, imaging findings, and treatment approaches related to PPA
-    7. All references must come from the provided JSON file
-    8. Format your output as JSON that follows the schema I've provided
-    9. Do not limit your extraction to a small number of sentences - be comprehensive and capture ALL significant research statements throughout the paper
+async def extract_and_rank_references_async(manuscript_text: str, references_json: List[Dict[str, Any]], output_path: str) -> str:
     """
+    Extract key sentences about Maria Luisa Gorno-Tempini's work from the manuscript and
+    rank the most appropriate references from the PubMed search results.
     
+    The manuscript is tiled into overlapping windows that are analyzed concurrently, and
+    key sentences found in more than one window are kept once.
+    
+    Args:
+        manuscript_text: The manuscript text to analyze
+        references_json: List of references from PubMed search results
+        output_path: Path to save the extracted sentences with ranked references
+        
+    Returns:
+        Path to the saved file with extracted sentences and ranked references
+    """
     print("Extracting sentences about Gorno-Tempini's work and ranking references")
     
+    result_jsons = []
     try:
-        response = client.beta.chat.completions.parse(
-            model="gpt-4o-2024-08-06", #"o1-mini-2024-09-12",
-            messages=[
-                {"role": "user", "content": prompt}
-            ],
-            response_format=StudyExtractionResult
-        )
-            
-        result_json = response.choices[0].message.content
+        # Only the locally retrieved candidates go into the prompt, instead of every reference
+        windows = await _window_prompts(manuscript_text, references_json)
+        result_jsons = await asyncio.gather(*[
+            _request_ranking(sentences_str, references_str) for sentences_str, references_str in windows
+        ])
         
-        # Parse the JSON - should be valid due to response_format enforcement
-        result_dict = json.loads(result_json)
-        
-        # Validate with our Pydantic schema for extra safety
-        extraction_result = StudyExtractionResult(**result_dict)
+        # Validate each window with our Pydantic schema, then merge them in manuscript order
+        key_sentences = {}
+        for result_json in result_jsons:
+            for key_sentence in StudyExtractionResult.model_validate_json(result_json).key_sentences:
+                key_sentences.setdefault(_sentence_key(key_sentence.verbatim_context), key_sentence)
+        extraction_result = StudyExtractionResult(key_sentences=list(key_sentences.values()))
         
         # Save the validated result
         with open(output_path, 'w', encoding='utf-8') as f:
@@ -88,16 +157,31 @@ def extract_and_rank_references(manuscript_text: str, references_json: List[Dict
         error_path = f"{output_path}.error"
         try:
             with open(error_path, 'w', encoding='utf-8') as f:
-                f.write(result_json if 'result_json' in locals() else str(e))
+                f.write("\n".join(result_jsons) if result_jsons else str(e))
             print(f"Error output saved to {error_path}")
         except:
             print("Could not save error output")
         
         return None
 
-def run_reference_ranking_agent(manuscript_path: str, references_json_path: str, output_path: str) -> str:
+def extract_and_rank_references(manuscript_text: str, references_json: List[Dict[str, Any]], output_path: str) -> str:
     """
-    Run the reference ranking agent.
+    Extract key sentences about Maria Luisa Gorno-Tempini's work from the manuscript and
+    rank the most appropriate references from the PubMed search results.
+    
+    Args:
+        manuscript_text: The manuscript text to analyze
+        references_json: List of references from PubMed search results
+        output_path: Path to save the extracted sentences with ranked references
+        
+    Returns:
+        Path to the saved file with extracted sentences and ranked references
+    """
+    return asyncio.run(extract_and_rank_references_async(manuscript_text, references_json, output_path))
+
+async def run_reference_ranking_agent_async(manuscript_path: str, references_json_path: str, output_path: str) -> str:
+    """
+    Run the reference ranking agent inside an event loop.
     
     Args:
         manuscript_path: Path to the manuscript to analyze
@@ -108,14 +192,26 @@ def run_reference_ranking_agent(manuscript_path: str, references_json_path: str,
         Path to the saved file with extracted sentences and ranked references
     """
     # Read the manuscript
-    with open(manuscript_path, 'r', encoding='utf-8') as f:
-        manuscript_text = f.read()
+    manuscript_text = await read_text_async(manuscript_path)
     
     # Read the references JSON
-    with open(references_json_path, 'r', encoding='utf-8') as f:
-        references_json = json.load(f)
+    references_json = read_json(references_json_path)
+    
+    return await extract_and_rank_references_async(manuscript_text, references_json, output_path)
+
+def run_reference_ranking_agent(manuscript_path: str, references_json_path: str, output_path: str) -> str:
+    """
+    Run the reference ranking agent.
     
-    return extract_and_rank_references(manuscript_text, references_json, output_path)
+    Args:
+        manuscript_path: Path to the manuscript to analyze
+        references_json_path: Path to the JSON file with references
+        output_path: Path to save the extracted sentences with ranked references
+        
+    Returns:
+        Path to the saved file with extracted sentences and ranked references
+    """
+    return asyncio.run(run_reference_ranking_agent_async(manuscript_path, references_json_path, output_path))
 
 if __name__ == "__main__":
     # Test the agent
@@ -0,0 +1,213 @@
+import os
+import re
+import math
+import asyncio
+import heapq
+import functools
+from collections import Counter
+from typing import Dict, Any, List, Optional
+
+import numpy as np
+
+try:
+    import tiktoken
+except ImportError:  # Token counts fall back to a character estimate
+    tiktoken = None
+
+from agents._io import dumps_json
+from agents.cache import EMBEDDING_MODEL, embed
+
+# Reference embeddings are computed once per PMID and kept next to the PubMed results
+EMBEDDINGS_PATH = "data/pubmed/embeddings.npz"
+
+# Inputs per embeddings request, well under the endpoint's per-request limits
+EMBEDDING_BATCH_SIZE = 256
+
+# Abstracts are cut to this many characters in prompts; their opening states the topic and main findings
+PROMPT_ABSTRACT_CHARS = 600
+
+_TOKEN_RE = re.compile(r"\w+")
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+def tokenize(text: str) -> List[str]:
+    """Lower-cased word tokens used for lexical matching"""
+    return _TOKEN_RE.findall(text.lower())
+
+def split_sentences(text: str) -> List[str]:
+    """Split text into sentences on terminal punctuation followed by whitespace"""
+    return [sentence for sentence in _SENTENCE_RE.split(text.strip()) if sentence]
+
+def reference_text(reference: Dict[str, Any]) -> str:
+    """The searchable text of a PubMed record: its title followed by its abstract"""
+    return f"{reference.get('title', '')} {reference.get('abstract', '')}"
+
+@functools.lru_cache(maxsize=1)
+def _encoding():
+    """The gpt-4o tokenizer, loaded on first use"""
+    return tiktoken.encoding_for_model("gpt-4o")
+
+def count_tokens(text: str) -> int:
+    """Number of gpt-4o tokens in text, estimated at four characters per token without tiktoken"""
+    if tiktoken is not None:
+        return len(_encoding().encode(text))
+    return max(1, len(text) // 4)
+
+def sentence_windows(sentences: List[str], max_tokens: int = 1500, overlap_tokens: int = 200) -> List[range]:
+    """
+    Group consecutive sentences into overlapping windows.
+
+    Args:
+        sentences: The sentences of a document, in order.
+        max_tokens: Token budget of a window; a single longer sentence forms a window of its own.
+        overlap_tokens: Each window repeats up to this many tokens of trailing sentences from the previous one.
+
+    Returns:
+        Ranges of sentence indices, one per window.
+    """
+    lengths = [count_tokens(sentence) for sentence in sentences]
+    windows = []
+    start = 0
+    while start < len(sentences):
+        end = start
+        total = 0
+        while end < len(sentences) and (end == start or total + lengths[end] <= max_tokens):
+            total += lengths[end]
+            end += 1
+        windows.append(range(start, end))
+        if end == len(sentences):
+            break
+
+        # Start the next window a few sentences back, always moving forward by at least one and
+        # keeping room for sentence `end`, so the window never falls inside the previous one
+        next_start = end
+        overlap = 0
+        while (
+            next_start > start + 1
+            and overlap + lengths[next_start - 1] <= overlap_tokens
+            and overlap + lengths[next_start - 1] + lengths[end] <= max_tokens
+        ):
+            next_start -= 1
+            overlap += lengths[next_start]
+        start = next_start
+    return windows
+
+def references_for_prompt(references: List[Dict[str, Any]], max_authors: Optional[int] = None) -> str:
+    """
+    Serialize references for a prompt as compact JSON, keeping only the fields the model needs.
+
+    Args:
+        references: PubMed records.
+        max_authors: Keep only the first authors of each record, or all of them if None.
+
+    Returns:
+        A JSON array without indentation or extra whitespace.
+    """
+    return dumps_json([
+        {
+            "pmid": reference["pmid"],
+            "title": reference.get("title", ""),
+            "authors": reference.get("authors", [])[:max_authors],
+            "year": reference.get("year", ""),
+            "journal": reference.get("journal", ""),
+            "abstract": reference.get("abstract", "")[:PROMPT_ABSTRACT_CHARS]
+        }
+        for reference in references
+    ]).decode("utf-8")
+
+class BM25:
+    """Okapi BM25 ranking over a fixed corpus of tokenized documents"""
+
+    def __init__(self, corpus: List[List[str]], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_freqs = [Counter(document) for document in corpus]
+        self.lengths = [len(document) for document in corpus]
+        self.avg_length = sum(self.lengths) / len(corpus) if corpus and sum(self.lengths) else 1.0
+
+        document_freqs = Counter(term for freqs in self.term_freqs for term in freqs)
+        self.idf = {
+            term: math.log(1 + (len(corpus) - freq + 0.5) / (freq + 0.5))
+            for term, freq in document_freqs.items()
+        }
+
+    def scores(self, query: List[str]) -> List[float]:
+        """Score every document of the corpus against the query tokens"""
+        query_terms = [term for term in set(query) if term in self.idf]
+        scores = []
+        for freqs, length in zip(self.term_freqs, self.lengths):
+            norm = self.k1 * (1 - self.b + self.b * length / self.avg_length)
+            scores.append(sum(
+                self.idf[term] * freqs[term] * (self.k1 + 1) / (freqs[term] + norm)
+                for term in query_terms if term in freqs
+            ))
+        return scores
+
+    def top_k(self, query: List[str], k: int) -> List[int]:
+        """Indices of the k best-scoring documents, best first"""
+        scores = self.scores(query)
+        return heapq.nlargest(k, range(len(scores)), key=scores.__getitem__)
+
+async def embed_texts(texts: List[str]) -> np.ndarray:
+    """
+    Embed texts in concurrent batches through the semantic cache's embedding call.
+
+    Args:
+        texts: Texts to embed.
+
+    Returns:
+        One L2-normalized row per text.
+    """
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    batches = await asyncio.gather(*[
+        embed(texts[i:i + EMBEDDING_BATCH_SIZE]) for i in range(0, len(texts), EMBEDDING_BATCH_SIZE)
+    ])
+    return np.concatenate(batches)
+
+async def load_reference_embeddings(references: List[Dict[str, Any]], path: str = EMBEDDINGS_PATH) -> np.ndarray:
+    """
+    Get the title+abstract embeddings of the references, embedding only PMIDs not stored yet.
+
+    Args:
+        references: PubMed records.
+        path: The .npz file holding previously computed embeddings.
+
+    Returns:
+        One L2-normalized row per reference, in the order of references.
+    """
+    stored = {}
+    if os.path.exists(path):
+        with np.load(path) as data:
+            if str(data["model"]) == EMBEDDING_MODEL:
+                stored = dict(zip(data["pmids"].tolist(), data["vectors"]))
+
+    missing = [reference for reference in references if reference["pmid"] not in stored]
+    if missing:
+        print(f"Embedding {len(missing)} references")
+        stored.update(zip((reference["pmid"] for reference in missing), await embed_texts([reference_text(reference) for reference in missing])))
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez(path, model=EMBEDDING_MODEL, pmids=np.array(list(stored)), vectors=np.array(list(stored.values()), dtype=np.float32))
+
+    return np.array([stored[reference["pmid"]] for reference in references], dtype=np.float32)
+
+def top_k_similar(queries: np.ndarray, corpus: np.ndarray, k: int) -> np.ndarray:
+    """
+    Find the most similar corpus rows for each query row.
+
+    Args:
+        queries: L2-normalized query embeddings.
+        corpus: L2-normalized corpus embeddings.
+        k: Number of neighbours per query.
+
+    Returns:
+        An array of shape (len(queries), min(k, len(corpus))) with corpus indices, best first.
+    """
+    scores = queries @ corpus.T
+    k = min(k, corpus.shape[0])
+    if k < corpus.shape[0]:
+        # Select the top k in linear time, then order only those k
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.broadcast_to(np.arange(k), (scores.shape[0], k))
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1)
+    return np.take_along_axis(candidates, order, axis=1)
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Type
 
 class ReferenceAPA(BaseModel):
     """Represents a single reference formatted in APA style."""
@@ -39,3 +39,62 @@ class StudyExtractionResult(BaseModel):
         ...,
         description="List of key sentences extracted from the study, each with its top 3 references."
     )
+
+class MarkerMatch(BaseModel):
+    """References selected for a single [REF] marker."""
+    pmids: List[str] = Field(
+        ...,
+        description="PMIDs of up to 3 candidate references that support the claim before the marker, most relevant first. Empty if no candidate supports it."
+    )
+
+class SentenceReferenceMatches(BaseModel):
+    """
+    Container model for the references matched to the [REF] markers
+    of one target sentence, in the order the markers appear.
+    """
+    markers: List[MarkerMatch] = Field(
+        ...,
+        description="One entry per [REF] marker in the target sentence, in order of appearance."
+    )
+
+
+def _strict(node: Any) -> Any:
+    """Rewrite a JSON schema node in place to satisfy OpenAI's strict structured outputs."""
+    if isinstance(node, dict):
+        # Strict mode requires every property to be listed as required and no extra keys;
+        # optional fields stay optional through their null type, and defaults are not allowed
+        if node.get("type") == "object" and "properties" in node:
+            node["additionalProperties"] = False
+            node["required"] = list(node["properties"])
+        node.pop("default", None)
+        for value in node.values():
+            _strict(value)
+    elif isinstance(node, list):
+        for value in node:
+            _strict(value)
+    return node
+
+def strict_response_format(model: Type[BaseModel]) -> Dict[str, Any]:
+    """
+    Build the json_schema response_format for a Pydantic model.
+    
+    Computing it once at import spares the .parse() helper from deriving the schema again
+    on every call; the response is then validated with model.model_validate_json.
+    
+    Args:
+        model: The Pydantic model the response must follow.
+        
+    Returns:
+        A response_format dict for chat.completions.create.
+    """
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": model.__name__,
+            "schema": _strict(model.model_json_schema()),
+            "strict": True
+        }
+    }
+
+STUDY_EXTRACTION_FORMAT = strict_response_format(StudyExtractionResult)
+SENTENCE_MATCHES_FORMAT = strict_response_format(SentenceReferenceMatches)
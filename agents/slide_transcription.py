@@ -1,71 +1,107 @@
 #%%
+"""
+Transcribe presentation slides with GPT-4o, using the per-slide context in boon_lead.json.
+
+Run from the repository root with `python -m agents.slide_transcription [--sync]`, so the
+agents package is importable and .env and boon_lead.json are found in the working directory.
+"""
 import io
+import time
+import asyncio
+import argparse
 import base64
+import hashlib
 import json
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import pdf2image
-from openai import AzureOpenAI
+from PIL import Image
 from dotenv import load_dotenv
 
+from agents._llm_client import get_client, get_async_client, request_slot
+from agents.cache import semantic_cache
+
 
 #%% Load environment variables
 load_dotenv('.env', override=True)  # Use override=True to force overwriting
 
+#%% Parse options
+# Slides go through the discounted Batch API by default; --sync transcribes them right away for development
+parser = argparse.ArgumentParser(description="Transcribe presentation slides with GPT-4o.")
+parser.add_argument("--sync", action="store_true", help="Call the model directly instead of submitting a batch job")
+args, _ = parser.parse_known_args()
+
 #%% Define dirs
 
 pdf_path = "/Users/pinheirochagas/Documents/ppa_marilu_ai/boon_lead_ppt.pdf"
 
 #%% Convert PDF to images
+# Rasterized slides are kept per (PDF path, modification time, DPI), so reruns skip poppler
+SLIDE_CACHE_DIR = "data/cache/slides"
+
 def pdf_to_images(pdf_path, dpi=300):
-    """Convert PDF to images with specified DPI for better quality"""
-    return pdf2image.convert_from_path(pdf_path, dpi=dpi)
+    """Convert PDF to images with specified DPI for better quality, reusing PNGs from earlier runs"""
+    key = f"{os.path.abspath(pdf_path)}:{os.path.getmtime(pdf_path)}:{dpi}"
+    cache_dir = os.path.join(SLIDE_CACHE_DIR, hashlib.sha1(key.encode()).hexdigest())
+    
+    if not os.path.isdir(cache_dir):
+        # Rasterize straight to PNG files in a scratch folder, then publish it in one rename
+        # so an interrupted run never leaves a partial deck in the cache
+        os.makedirs(SLIDE_CACHE_DIR, exist_ok=True)
+        scratch_dir = tempfile.mkdtemp(dir=SLIDE_CACHE_DIR)
+        pdf2image.convert_from_path(pdf_path, dpi=dpi, output_folder=scratch_dir, fmt="png", output_file="slide", paths_only=True)
+        os.replace(scratch_dir, cache_dir)
+    
+    # Page numbers in the file names are zero-padded, so name order is slide order
+    return [Image.open(os.path.join(cache_dir, name)) for name in sorted(os.listdir(cache_dir))]
 
 # You can adjust the DPI based on your needs (higher = better quality but larger files)
 pdf_images = pdf_to_images(pdf_path, dpi=300)
 pdf_images_df = pd.DataFrame({'images': pdf_images})
 
 #%% Encode an image to base64
-def encode_image(image, quality=100):
-    """Encode image to base64 with specified quality"""
+# GPT-4o downscales larger images to fit this size anyway, so sending more pixels only costs upload time
+MAX_IMAGE_SIZE = 1568
+
+def encode_image(image, quality=85):
+    """Encode image to base64 JPEG with specified quality, downscaled to MAX_IMAGE_SIZE"""
+    # convert() returns a copy, so the thumbnail does not shrink the caller's image
+    image = image.convert("RGB")
+    image.thumbnail((MAX_IMAGE_SIZE, MAX_IMAGE_SIZE), Image.LANCZOS)
     buffered = io.BytesIO()
-    image.save(buffered, format="PNG", quality=quality)
+    image.save(buffered, format="JPEG", quality=quality, optimize=True)
     return base64.b64encode(buffered.getvalue()).decode("utf-8")
 
-#%% Define LLM client
-client = AzureOpenAI(
-        api_key=os.getenv("VERSA_OPENAI_API_KEY"),
-        api_version=os.getenv("VERSA_API_VERSION"),
-        azure_endpoint=os.getenv("VERSA_RESOURCE_ENDPOINT")
-    )
+# Pillow releases the GIL while resizing and compressing, so slides are encoded on several threads
+ENCODE_WORKERS = min(8, os.cpu_count() or 1)
+
 #%%
 # import boon_lead.json as dictionary
 with open("boon_lead.json", "r") as f:
     boon_lead_contexts = json.load(f)
 
+context_by_slide = {context['slide']: context['content'] for context in boon_lead_contexts}
+
 #%% Process each slide with context
-results = []
+# Workers taking encoded slides off the queue; the requests themselves share the loop's request slots
+SLIDE_CONCURRENCY = 8
 
+SLIDE_MODEL = "gpt-4o-2024-08-06"
 
-for i, image in enumerate(pdf_images):
-    slide_number = i + 1
-    
-    # Find the matching context for this slide
-    slide_context = None
-    for context in boon_lead_contexts:
-        if context['slide'] == slide_number:
-            slide_context = context['content']
-            break
+def get_slide_context(slide_number):
+    """Context for a slide from boon_lead.json, or a placeholder if there is none"""
+    slide_context = context_by_slide.get(slide_number)
     
     if not slide_context:
         print(f"Warning: No context found for slide {slide_number}")
         slide_context = "No context available for this slide."
-    
-    # Encode the image
-    base64_image = encode_image(image)
-    
-    # Prepare the message for the LLM
-    messages = [
+    return slide_context
+
+def build_messages(slide_context, slide_number, base64_image):
+    """Prepare the message for the LLM"""
+    return [
         {
             "role": "user",
             "content": [
@@ -76,33 +112,138 @@ for i, image in enumerate(pdf_images):
                 {
                     "type": "image_url",
                     "image_url": {
-                        "url": f"data:image/png;base64,{base64_image}"
+                        "url": f"data:image/jpeg;base64,{base64_image}"
                     }
                 }
             ]
         }
     ]
-    
+
+# The slide image and number are matched exactly, so slides with similar context never share a transcript
+@semantic_cache(threshold=0.95, context=("slide_number", "base64_image"))
+async def transcribe_slide(slide_context, *, slide_number, base64_image):
+    """Ask the model to transcribe one slide image"""
     # Call the LLM
-    print(f"Processing slide {slide_number}...")
-    response = client.chat.completions.create(
-        model="gpt-4o-2024-08-06",
-        messages=messages,
-        max_tokens=1000
-    )
+    async with request_slot():
+        response = await get_async_client().chat.completions.create(
+            model=SLIDE_MODEL,
+            messages=build_messages(slide_context, slide_number, base64_image),
+            max_tokens=1000
+        )
+    return response.choices[0].message.content
+
+async def process_slide(slide_number, base64_image):
+    """Transcribe one slide, using its context from boon_lead.json"""
+    # Find the matching context for this slide
+    slide_context = get_slide_context(slide_number)
     
-    # Extract and save the result
-    transcript = response.choices[0].message.content
+    print(f"Processing slide {slide_number}...")
+    transcript = await transcribe_slide(slide_context, slide_number=slide_number, base64_image=base64_image)
     
-    # Store result
-    result = {
+    print(f"Completed slide {slide_number}")
+    return {
         "slide": slide_number,
         "context": slide_context,
         "transcript": transcript
     }
-    results.append(result)
+
+async def encode_slides(queue, images, executor):
+    """Encode slides on the executor and queue them in slide order, followed by one stop marker per worker"""
+    loop = asyncio.get_running_loop()
+    encodings = [loop.run_in_executor(executor, encode_image, image) for image in images]
+    for i, encoding in enumerate(encodings):
+        await queue.put((i + 1, await encoding))
+    for _ in range(SLIDE_CONCURRENCY):
+        await queue.put(None)
+
+async def transcribe_worker(queue, results):
+    """Transcribe queued slides until the stop marker"""
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        slide_number, base64_image = item
+        results.append(await process_slide(slide_number, base64_image))
+
+async def transcribe_slides_async(images):
+    """Transcribe all slides concurrently and return the results in slide order"""
+    # Encoding runs on worker threads while earlier slides are with the model, so it stays off the critical path
+    queue = asyncio.Queue()
+    results = []
+    with ThreadPoolExecutor(max_workers=ENCODE_WORKERS) as executor:
+        await asyncio.gather(
+            encode_slides(queue, images, executor),
+            *[transcribe_worker(queue, results) for _ in range(SLIDE_CONCURRENCY)]
+        )
+    return sorted(results, key=lambda result: result["slide"])
+
+#%% Transcribe slides through the Batch API
+# Azure batch requests address the chat completions route of the deployment named in each body
+BATCH_ENDPOINT = "/chat/completions"
+BATCH_POLL_INTERVAL = 30
+
+def transcribe_slides_batch(images):
+    """Transcribe all slides in one Batch API job and return the results in slide order"""
+    client = get_client()
     
-    print(f"Completed slide {slide_number}")
+    with ThreadPoolExecutor(max_workers=ENCODE_WORKERS) as executor:
+        encoded_images = list(executor.map(encode_image, images))
+    
+    # One request line per slide, identified by its slide number
+    contexts = {}
+    lines = []
+    for i, base64_image in enumerate(encoded_images):
+        slide_number = i + 1
+        contexts[slide_number] = get_slide_context(slide_number)
+        lines.append(json.dumps({
+            "custom_id": f"slide_{slide_number}",
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": {
+                "model": SLIDE_MODEL,
+                "messages": build_messages(contexts[slide_number], slide_number, base64_image),
+                "max_tokens": 1000
+            }
+        }))
+    
+    batch_input = io.BytesIO(("\n".join(lines) + "\n").encode("utf-8"))
+    input_file = client.files.create(file=("slide_transcription_batch.jsonl", batch_input), purpose="batch")
+    batch = client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT, completion_window="24h")
+    print(f"Submitted batch {batch.id} with {len(lines)} slides")
+    
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(BATCH_POLL_INTERVAL)
+        batch = client.batches.retrieve(batch.id)
+        print(f"Batch {batch.id}: {batch.status}")
+    
+    if batch.status != "completed" or not batch.output_file_id:
+        raise RuntimeError(f"Batch {batch.id} ended with status {batch.status}")
+    
+    # Output lines arrive in completion order; slides whose request failed are kept without a transcript
+    transcripts = {}
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        record = json.loads(line)
+        slide_number = int(record["custom_id"].split("_")[1])
+        response = record.get("response") or {}
+        if response.get("status_code") == 200:
+            transcripts[slide_number] = response["body"]["choices"][0]["message"]["content"]
+    
+    results = []
+    for slide_number, slide_context in sorted(contexts.items()):
+        if slide_number not in transcripts:
+            print(f"Warning: No transcript returned for slide {slide_number}")
+        results.append({
+            "slide": slide_number,
+            "context": slide_context,
+            "transcript": transcripts.get(slide_number)
+        })
+    return results
+
+#%% Run the transcription
+if args.sync:
+    results = asyncio.run(transcribe_slides_async(pdf_images))
+else:
+    results = transcribe_slides_batch(pdf_images)
 
 #%% Save all results
 with open("slide_transcriptions.json", "w") as f:
@@ -1,100 +1,158 @@
+"""
+Convert a talk transcript into a scientific perspective article.
+
+Run from the repository root with `python -m agents.transcript_to_perspective_agent`.
+"""
 import os
-from typing import Dict, Any
-from openai import AzureOpenAI
+import asyncio
+from typing import Dict, Any, Optional
 
-def convert_transcript_to_perspective(transcript: str, topic: str, output_path: str) -> str:
+from agents._io import read_text_async
+from agents._llm_client import get_async_client, request_slot
+from agents.cache import semantic_cache
+
+PERSPECTIVE_INSTRUCTIONS = """Please convert the provided transcript into a scientific perspective article about the given topic following the guidelines below:
+
+IMPORTANT INSTRUCTIONS:
+CRITICAL: Include ALL scientific content from the transcript.
+1. Maintain the personal perspective, while adhering to the scientific content.
+2. DO NOT add any new scientific content, facts, or research that is not present in the transcript
+3. Only restructure and format the existing content to fit a perspective paper format
+4. You may clarify concepts mentioned in the transcript, but do not introduce topics not discussed
+5. No bullet points.
+
+Below are some general guidelines for perspective articles:
+Perspective Article Guidelines: Perspective articles serve as a platform for authors to discuss models and ideas from a personal viewpoint. They are characterized by the following features:
+More forward-looking and speculative than Review articles
+May take a narrower field of view
+Can present opinionated viewpoints while maintaining balance
+Intended to stimulate discussion and new experimental approaches
+
+Format Requirements
+Begin with a 200-word maximum preface that sets the stage and ends with a summary sentence.
+Minimum 8 pages, maximum 10 pages in length
+Target word count: minimum 4,000 and maximum 5,000 words
+
+Content Guidelines
+Focus on one topical aspect of a field rather than providing comprehensive literature surveys
+Can present controversial viewpoints but should briefly indicate opposing perspectives
+Should not focus primarily on the author's own work
+Use accessible language
+Define novel concepts
+Explain specialist terminology"""
+
+# The topic is short, so it is matched exactly rather than by embedding similarity
+@semantic_cache(threshold=0.95, context=("topic",))
+async def _request_perspective(transcript: str, *, topic: str, output_path: str) -> str:
     """
-    Convert a transcript into a scientific perspective article.
+    Ask the model to write a perspective article from the transcript, streaming it to disk.
     
     Args:
         transcript: The transcript text to convert.
         topic: The topic of the perspective article.
-        output_path: Path to save the generated article.
+        output_path: File the article is written to while it is generated.
         
     Returns:
-        Path to the saved article file.
+        The perspective article text.
     """
-    client = AzureOpenAI(
-        api_key=os.environ["VERSA_OPENAI_API_KEY"],
-        api_version=os.environ['VERSA_API_VERSION'],
-        azure_endpoint=os.environ['VERSA_RESOURCE_ENDPOINT']
-    )
-    
-    prompt = f"""
-
-    Please convert the provided transcript into a scientific perspective article about the topic: {topic} following the guidelines above below:
-
-    IMPORTANT INSTRUCTIONS:
-    CRITICAL: Include ALL scientific content from the transcript. 
-    1. Maintain the personal perspective, while adhering to the scientific content.
-    2. DO NOT add any new scientific content, facts, or research that is not present in the transcript
-    3. Only restructure and format the existing content to fit a perspective paper format
-    4. You may clarify concepts mentioned in the transcript, but do not introduce topics not discussed
-    5. No bullet points. 
+    client = get_async_client()
     
-    Below are some general guidelines for perspective articles:
-    Perspective Article Guidelines: Perspective articles serve as a platform for authors to discuss models and ideas from a personal viewpoint. They are characterized by the following features:
-    More forward-looking and speculative than Review articles
-    May take a narrower field of view
-    Can present opinionated viewpoints while maintaining balance
-    Intended to stimulate discussion and new experimental approaches
+    prompt = f"TOPIC: {topic}\n\nTRANSCRIPT:\n\n{transcript}"
     
-    Format Requirements
-    Begin with a 200-word maximum preface that sets the stage and ends with a summary sentence. 
-    Minimum 8 pages, maximum 10 pages in length
-    Target word count: minimum 4,000 and maximum 5,000 words
+    # Stream the response so the article appears on disk as soon as generation starts
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    parts = []
+    async with request_slot():
+        stream = await client.chat.completions.create(
+            model="o1-2024-12-17",
+            messages=[
+                {"role": "system", "content": PERSPECTIVE_INSTRUCTIONS},
+                {"role": "user", "content": prompt}
+            ],
+            reasoning_effort="high",
+            stream=True
+        )
+        with open(output_path, 'w', encoding='utf-8', buffering=1) as f:
+            async for chunk in stream:
+                # Azure sends chunks without choices for content filter results
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    f.write(parts[-1])
+    
+    return "".join(parts)
+
+async def convert_transcript_to_perspective_async(transcript: str, topic: str, output_path: str) -> str:
+    """
+    Convert a transcript into a scientific perspective article.
     
-    Content Guidelines
-    Focus on one topical aspect of a field rather than providing comprehensive literature surveys
-    Can present controversial viewpoints but should briefly indicate opposing perspectives
-    Should not focus primarily on the author's own work
-    Use accessible language
-    Define novel concepts
-    Explain specialist terminology
+    Args:
+        transcript: The transcript text to convert.
+        topic: The topic of the perspective article.
+        output_path: Path to save the generated article.
         
-    
-    {transcript}
+    Returns:
+        Path to the saved article file.
     """
-    
     print(f"Converting transcript to perspective article about: {topic}")
     
-    response = client.chat.completions.create(
-        model="o1-2024-12-17",
-        messages=[
-            {"role": "user", "content": prompt}
-        ],
-        reasoning_effort="high"
-    )
-    
-    perspective_article = response.choices[0].message.content
+    perspective_article = await _request_perspective(transcript, topic=topic, output_path=output_path)
     
     # Create output directory if it doesn't exist
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
     
-    # Save the perspective article to file
+    # Save the complete article; a semantic cache hit returns it without streaming
     with open(output_path, 'w', encoding='utf-8') as f:
         f.write(perspective_article)
     
     print(f"Perspective article generated and saved to {output_path}")
     return output_path
 
-def run_transcript_agent(transcript_path: str, topic: str, output_path: str) -> str:
+def convert_transcript_to_perspective(transcript: str, topic: str, output_path: str) -> str:
     """
-    Run the transcript to perspective article agent.
+    Convert a transcript into a scientific perspective article.
+    
+    Args:
+        transcript: The transcript text to convert.
+        topic: The topic of the perspective article.
+        output_path: Path to save the generated article.
+        
+    Returns:
+        Path to the saved article file.
+    """
+    return asyncio.run(convert_transcript_to_perspective_async(transcript, topic, output_path))
+
+async def run_transcript_agent_async(transcript_path: str, topic: str, output_path: str, transcript_text: Optional[str] = None) -> str:
+    """
+    Run the transcript to perspective article agent inside an event loop.
     
     Args:
         transcript_path: Path to the transcript file.
         topic: The topic of the perspective article.
         output_path: Path to save the generated article.
+        transcript_text: The transcript, if the caller already holds it; transcript_path is then not read.
         
     Returns:
         Path to the saved article file.
     """
     # Read the transcript
-    with open(transcript_path, 'r', encoding='utf-8') as f:
-        transcript = f.read()
+    transcript = transcript_text if transcript_text is not None else await read_text_async(transcript_path)
     
-    return convert_transcript_to_perspective(transcript, topic, output_path)
+    return await convert_transcript_to_perspective_async(transcript, topic, output_path)
+
+def run_transcript_agent(transcript_path: str, topic: str, output_path: str, transcript_text: Optional[str] = None) -> str:
+    """
+    Run the transcript to perspective article agent.
+    
+    Args:
+        transcript_path: Path to the transcript file.
+        topic: The topic of the perspective article.
+        output_path: Path to save the generated article.
+        transcript_text: The transcript, if the caller already holds it; transcript_path is then not read.
+        
+    Returns:
+        Path to the saved article file.
+    """
+    return asyncio.run(run_transcript_agent_async(transcript_path, topic, output_path, transcript_text))
 
 if __name__ == "__main__":
     # Test the agent
@@ -1,5 +1,9 @@
 import os
 import sys
+import asyncio
+import difflib
+import argparse
+from typing import Tuple
 from dotenv import load_dotenv
 from datetime import datetime
 
@@ -7,16 +11,64 @@ from datetime import datetime
 load_dotenv()
 
 # Import agent functions
-from agents.pubmed_agent import run_pubmed_agent
-from agents.transcript_to_perspective_agent import run_transcript_agent
-from agents.reference_marking_agent import run_reference_marking_agent
-from agents.reference_matching_agent import run_reference_matching_agent
-from agents.article_review_agent import run_article_review_agent
-from agents.article_improvement_agent import run_article_improvement_agent
+from agents.pubmed_agent import run_pubmed_agent_async
+from agents.transcript_to_perspective_agent import run_transcript_agent_async
+from agents.reference_marking_agent import run_reference_marking_agent_async
+from agents.reference_matching_agent import run_reference_matching_agent_async
+from agents.article_review_agent import review_article_async
+from agents.article_improvement_agent import improve_article_text_async
+from agents.cache import set_llm_cache_enabled, cache_stats
+from agents._io import read_text_async
 
+# Review and improvement rounds run on the perspective article
+REVIEW_ITERATIONS = 3
 
-def main():
-    """Run the agentic AI scientific writer pipeline."""
+# An improvement this similar to its input counts as converged, and the remaining iterations are skipped
+CONVERGENCE_RATIO = 0.99
+
+
+async def review_and_improve_async(article_path: str, transcript_text: str, review_output: str, improved_output: str, iteration: int = 0) -> Tuple[str, str, str]:
+    """
+    Review a manuscript and improve it based on the resulting feedback.
+    
+    Args:
+        article_path: Path to the article file to review and improve.
+        transcript_text: The original transcript text.
+        review_output: Path to save the review feedback.
+        improved_output: Path to save the improved article.
+        iteration: Number of review and improvement rounds the article has already been through.
+        
+    Returns:
+        The path to the saved improved article, the article text and the improved text.
+    """
+    # The article is read once and shared by the review and the improvement
+    article_text = await read_text_async(article_path)
+    review_output = await review_article_async(article_text, transcript_text, review_output, iteration=iteration)
+    review_feedback = await read_text_async(review_output)
+    improved_text = await improve_article_text_async(article_text, review_feedback, transcript_text, improved_output, iteration)
+    return improved_output, article_text, improved_text
+
+
+async def run_pipeline_async(jobs, transcript_text: str, iteration: int = 0):
+    """
+    Review and improve several manuscripts concurrently.
+    
+    Args:
+        jobs: List of (article_path, review_output, improved_output) tuples, one per manuscript.
+        transcript_text: The original transcript text.
+        iteration: Number of review and improvement rounds the manuscripts have already been through.
+        
+    Returns:
+        One (improved_path, article_text, improved_text) tuple per manuscript, in the same order as jobs.
+    """
+    return await asyncio.gather(*[
+        review_and_improve_async(article_path, transcript_text, review_output, improved_output, iteration)
+        for article_path, review_output, improved_output in jobs
+    ])
+
+
+async def main_async():
+    """Run the agentic AI scientific writer pipeline inside one event loop."""
     
     # # Check for OpenAI API key
     if not os.getenv("VERSA_OPENAI_API_KEY"):
@@ -38,44 +90,69 @@ def main():
     marked_output = f"data/marked/marked_article_{timestamp}.txt"
     references_output = f"data/references/article_with_references_{timestamp}.txt"
     
-    # Step 1: Search PubMed
-    print("\n--- Step 1: Searching PubMed ---")
-    pubmed_output = run_pubmed_agent(pubmed_query, pubmed_output)
+    # The transcript is used by every LLM step, so it is read once and passed around as text
+    transcript_text = await read_text_async(transcript_path)
     
-    # Step 2: Convert transcript to perspective article
+    # Steps 1 and 2 share no data, so the PubMed search runs while the perspective article is generated
+    print("\n--- Step 1: Searching PubMed ---")
     print("\n--- Step 2: Converting transcript to perspective article ---")
-    perspective_output = run_transcript_agent(transcript_path, topic, perspective_output)
+    pubmed_output, perspective_output = await asyncio.gather(
+        run_pubmed_agent_async(pubmed_query, pubmed_output),
+        run_transcript_agent_async(transcript_path, topic, perspective_output, transcript_text)
+    )
     
-    # Steps 3-5: Iterative review and improvement (3 cycles)
+    # Steps 3-5: Iterative review and improvement (up to REVIEW_ITERATIONS cycles)
     current_article = perspective_output
 
     # Read the article file
     current_article = "data/references/article_with_references_20250322_184343.txt"
     
-    for i in range(3):
+    for i in range(REVIEW_ITERATIONS):
         print(f"\n--- Iteration {i+1}: Review and Improvement ---")
         
-        # Step 3: Review article
+        # Step 3 and 4: Review article, then improve it based on the feedback. Each review needs the
+        # previous iteration's improved article, so iterations cannot overlap
         review_output = f"data/review/review_feedback_{i+1}_{timestamp}.txt"
-        review_output = run_article_review_agent(current_article, transcript_path, review_output)
-        
-        # Step 4: Improve article
         improved_output = f"data/improved/improved_article_{i+1}_{timestamp}.txt"
-        improved_output = run_article_improvement_agent(current_article, review_output, transcript_path, improved_output)
+        cache_hits = cache_stats["hits"]
+        (improved_output, previous_text, improved_text), = await run_pipeline_async([(current_article, review_output, improved_output)], transcript_text, i)
+        
+        # Compare word sequences rather than characters, which is much cheaper on a 5,000-word article
+        similarity = difflib.SequenceMatcher(None, previous_text.split(), improved_text.split(), autojunk=False).ratio()
         
         # Update current article for next iteration
         current_article = improved_output
+        
+        # A cached review or improvement says nothing about what the model would change now, so only
+        # a freshly generated round can end the loop
+        fresh = cache_stats["hits"] == cache_hits
+        
+        if fresh and similarity > CONVERGENCE_RATIO and i < REVIEW_ITERATIONS - 1:
+            print(f"Improved article is {similarity:.1%} similar to its input; skipping the remaining iterations")
+            break
     
     # Step 5: Insert reference markers (moved after iterations)
     print("\n--- Step 5: Inserting reference markers ---")
-    marked_output = run_reference_marking_agent(current_article, marked_output)
+    marked_output = await run_reference_marking_agent_async(current_article, marked_output)
     
     # Step 6: Match references (moved after iterations)
     print("\n--- Step 6: Matching references to markers ---")
-    references_output = run_reference_matching_agent(marked_output, pubmed_output, references_output)
+    references_output = await run_reference_matching_agent_async(marked_output, pubmed_output, references_output)
     
     print("\n--- Process completed successfully ---")
     print(f"Final article with references saved to: {references_output}")
 
+
+def main():
+    """Run the agentic AI scientific writer pipeline."""
+    parser = argparse.ArgumentParser(description="Run the agentic AI scientific writer pipeline.")
+    parser.add_argument("--no-cache", action="store_true", help="Ignore and do not update the cached LLM responses")
+    args = parser.parse_args()
+    
+    if args.no_cache:
+        set_llm_cache_enabled(False)
+    
+    asyncio.run(main_async())
+
 if __name__ == "__main__":
     main()
\ No newline at end of file